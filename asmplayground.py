@@ -5,7 +5,18 @@
 
 import logging
 import subprocess
-import copy
+import sys
+import mmap
+import os
+import array
+import struct
+import hashlib
+import itertools
+import collections
+import functools
+import gc
+import glob
+import multiprocessing
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('SCFI')
@@ -36,9 +47,110 @@ class Environment():
 global_env = Environment(X86, ATT)
 
 
+def decode_line(s):
+    '''Single pass lexer, returns the fields cached by Line:
+    type: 'empty' 'instruction' 'comment' 'directive' 'label'
+    word: opcode/directive type(with dot)/label name(without colon)
+    args: the operands begin here
+    code_end: the comment begins here (or len(s) if no comment)
+    '''
+    code_end = s.find(global_env.comment_character)
+    if code_end < 0:
+        code_end = len(s)
+    tokens = s[:code_end].split(None, 1)
+    if not tokens:
+        return ('empty' if code_end == len(s) else 'comment'), None, code_end, code_end
+    args = code_end - len(tokens[1]) if len(tokens) > 1 else code_end
+    if tokens[-1].rstrip()[-1:] == ':':
+        return 'label', tokens[0].replace(':', ''), args, code_end
+    elif tokens[0][0] == '.':
+        return 'directive', sys.intern(tokens[0]), args, code_end
+    else:
+        return 'instruction', sys.intern(tokens[0]), args, code_end
+
+
+# an AT&T operand, decoded. kind: 'register' 'immediate' 'memory' 'symbol'
+# (a bare expression: the target of a direct branch, or an absolute memory
+# operand). text: the operand without '*', registers are named without '%'.
+Operand = collections.namedtuple(
+    'Operand', ('kind', 'text', 'indirect', 'reg', 'segment', 'disp', 'base', 'index', 'scale'))
+
+
+def split_operands(args):
+    '''Split at the commas which are not in parentheses'''
+    operands = []
+    depth = start = 0
+    for i, c in enumerate(args):
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and not depth:
+            operands.append(args[start:i])
+            start = i+1
+    operands.append(args[start:])
+    return [operand.strip() for operand in operands]
+
+
+def decode_operand(text):
+    '''Decode one AT&T operand, e.g. *%rax, $8, foo, *8(%rax,%rbx,4), %fs:0x28'''
+    indirect = text.startswith('*')
+    if indirect:
+        text = text[1:].lstrip()
+    if text.startswith('$'):
+        return Operand('immediate', text, indirect, None, None, text[1:], None, None, None)
+    rest, segment = text, None
+    if text.startswith('%'):
+        reg, colon, rest = text.partition(':')
+        if not colon:
+            return Operand('register', text, indirect, reg[1:], None, None, None, None, None)
+        segment, rest = reg[1:], rest.strip()
+    paren = rest.rfind('(')
+    if rest.endswith(')') and paren >= 0 and ('%' in rest[paren:] or ',' in rest[paren:]):
+        fields = [field.strip() for field in rest[paren+1:-1].split(',')]
+        fields += [''] * (3-len(fields))
+        base = fields[0][1:] or None
+        index = fields[1][1:] or None
+        scale = int(fields[2], 0) if fields[2] else (1 if index else None)
+        disp = rest[:paren].strip() or None
+        return Operand('memory', text, indirect, None, segment, disp, base, index, scale)
+    kind = 'memory' if segment else 'symbol'
+    return Operand(kind, text, indirect, None, segment, rest, None, None, None)
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def decode_operands(args):
+    '''The operands of an instruction (the text after the opcode, comment
+    stripped) as a tuple of Operand. Cached: the same operand texts repeat a
+    lot in a file.'''
+    if not args:
+        return ()
+    return tuple(decode_operand(operand) for operand in split_operands(args))
+
+
+def pack_loc(file_number, line, column=0):
+    '''A debug location packed into one int, cheap to hash and to keep'''
+    return (file_number << 64) | (line << 32) | column
+
+
+def unpack_loc(loc):
+    return loc >> 64, (loc >> 32) & 0xffffffff, loc & 0xffffffff
+
+
 class Line(str):
-    '''A line in asm file'''
+    '''A line in asm file
+    Lines are compact: no instance __dict__, the attributes are declared in
+    __slots__. The optional attributes (tags, slots, slots_info, slot_info,
+    reserved_tags) are only assigned on the marked lines, unassigned slots
+    cost nothing but the pointer.
+    '''
     key_id = 0  # we need a unique id for each Line, otherwise we cannot distinguish different line with the same content
+    __slots__ = ('_key_id', 'prev', 'next', 'type', '_word', '_args', '_code_end',
+                 'section_declaration', 'new_str', 'loc', '_src', '_order',
+                 'tags', 'slots', 'slots_info', 'slot_info', 'reserved_tags')
+
+    def __new__(cls, s, *args, **kwargs):
+        return super(Line, cls).__new__(cls, s)
 
     def __init__(self, s):
         self._key_id = Line.key_id
@@ -46,26 +158,15 @@ class Line(str):
         # index_of_line is too slow, we add a two-way link list
         self.prev = None
         self.next = None
-        # self.type: 'empty' 'instruction' 'comment' 'directive' 'label'
         # TODO: we assume no /*...*/ comments, or we should remove them in AsmSrc.__init__
         if "/*" in self:
             logger.warn('Not supported comment: /*...*/')
-
-        first_char = self.lstrip()[:1]
-        last_char = self.strip_comment().rstrip()[-1:]
-        if not first_char:
-            self.type = 'empty'
-        elif first_char == global_env.comment_character:
-            self.type = 'comment'
-        elif last_char == ':':
-            self.type = 'label'
-        elif first_char == '.':
-            self.type = 'directive'
-        else:
-            self.type = 'instruction'
-
+        self.type, self._word, self._args, self._code_end = decode_line(s)
         self.section_declaration = None
+        self.loc = None
         self.new_str = None
+        self._src = None  # byte offset in the source file, if read from it
+        self._order = None  # order label in the AsmSrc, see AsmSrc.is_before
 
     def __hash__(self):
         return hash(self._key_id)
@@ -86,11 +187,29 @@ class Line(str):
         return super().__str__()
 
     def strip_comment(self):
-        return self.split(global_env.comment_character)[0].strip()
+        return self[:self._code_end].strip()
+
+    def get_comment(self):
+        return self[self._code_end:]
+
+    @property
+    def byte_length(self):
+        '''Length of the original line in utf-8'''
+        return len(self) if self.isascii() else len(self.encode())
 
     def get_opcode(self):
         if self.is_instruction:
-            return self.split()[0]
+            return self._word
+
+    def get_operands(self):
+        '''Operands of an instruction/directive, comment stripped'''
+        return self[self._args:self._code_end].strip()
+
+    def decode_operands(self):
+        '''Operands of an instruction as a tuple of Operand, see decode_operand'''
+        if not self.is_instruction:
+            return ()
+        return decode_operands(self.get_operands())
 
     @property
     def is_empty(self): return self.type == 'empty'
@@ -105,110 +224,460 @@ class Line(str):
     def is_directive(self): return self.type == 'directive'
 
     # with dot
-    def get_directive_type(self): return self.strip_comment().strip().split()[
-        0] if self.is_directive else None
+    def get_directive_type(self): return self._word if self.is_directive else None
 
     @property
     def is_label(self): return self.type == 'label'
 
-    def get_label(self): return self.strip_comment().strip().split()[
-        0].replace(':', '') if self.is_label else ''
+    def get_label(self): return self._word if self.is_label else ''
 
     @property
     def is_section_directive(self):
-        return True if self.is_directive and self.get_directive_type() in ['.section', '.data', '.text'] else False
+        return True if self.is_directive and self._word in ('.section', '.data', '.text') else False
 
     def get_section(self):
         '''Return the section and the flags'''
         if not self.is_section_directive:
             return False
-        if self.get_directive_type() in ['.data', '.text']:
-            return self.get_directive_type()
-        return self.split(None, 1)[-1].strip()
+        if self._word in ('.data', '.text'):
+            return self._word
+        return self.get_operands()
 
     def get_bare_section(self):
         '''Return the section name only'''
-        return self.get_section().split(',', 1)[0]
+        return sys.intern(self.get_section().split(',', 1)[0])
+
+    def get_align(self):
+        '''log2 of the alignment of .p2align/.align/.balign, None for others'''
+        if not self.is_directive or self._word not in ALIGN_DIRECTIVES:
+            return None
+        try:
+            value = int(self.get_operands().split(',')[0], 0)
+        except ValueError:
+            return None  # an expression
+        return value if self._word == '.p2align' else value.bit_length()-1
 
     @property
     def is_loc_directive(self):
-        return True if self.is_directive and self.get_directive_type() == '.loc' else False
+        return True if self.is_directive and self._word == '.loc' else False
 
     @property
     def get_loc(self):
-        return ' '.join(self.split()[1:4])
+        '''(file number, line, column) of a .loc directive, see pack_loc'''
+        operands = self.get_operands().split()[:3]
+        try:
+            return pack_loc(*map(int, operands))
+        except ValueError:  # column omitted, options follow
+            return pack_loc(*map(int, operands[:2]))
 
     def set_loc(self, loc):
-        self.debug_loc = loc
+        self.loc = loc
+
+    @property
+    def debug_loc(self):
+        '''The location as the string "file line column"'''
+        if self.loc is None:
+            return None
+        return ' '.join(map(str, unpack_loc(self.loc)))
 
     @property
     def is_file_directive(self):
-        return True if self.is_directive and self.get_directive_type() == '.file' else False
+        return True if self.is_directive and self._word == '.file' else False
 
     @property
     # the .file has two version, old and DWARF2, we concern DWARF2 only.
     def is_debug_file_directive(self):
-        return True if self.is_file_directive and not self.strip_comment().split()[1].startswith('"') else False
+        return True if self.is_file_directive and not self.get_operands().startswith('"') else False
 
     def set_section_declaration(self, line):
         self.section_declaration = line
 
 
+ORDER_GAP = 1 << 32  # gap between order labels of two adjacent lines
+ALIGN_DIRECTIVES = ('.p2align', '.align', '.balign')
+LINE_TYPES = ('empty', 'instruction', 'comment', 'directive', 'label')
+
+# bump PARSER_VERSION when the parsing changes, the caches of older versions
+# are ignored then
+PARSER_VERSION = 3
+CACHE_MAGIC = b'SCFIASMC'
+CACHE_HEADER = struct.Struct('=8sI32sQ')  # magic, version, content hash, lines
+CACHE_BLOCK = struct.Struct('=cQ')        # array typecode, length
+# the slots of a Line kept in the parse cache, an array each, in this order.
+# load_cache sets the links, _key_id, _order, _src and new_str itself, the
+# other slots are only assigned after the parsing: a slot set while parsing
+# must be added here (dump_cache checks it).
+LINE_CACHE_SLOTS = ('type', '_word', '_args', '_code_end', 'section_declaration', 'loc')
+LINE_LOAD_SLOTS = ('_key_id', 'prev', 'next', 'new_str', '_src', '_order')
+
+
+class FunctionExtent():
+    '''A function in the asm, from the begin line to the end line (included).
+    clang marks them with '# -- Begin function' / '# -- End function', the
+    section declaration right before the begin line is included.'''
+    __slots__ = ('name', 'begin', 'end', 'section', 'type_line', 'size_line')
+
+    def __init__(self, name, begin, section):
+        self.name = name
+        self.begin = begin
+        self.end = None
+        self.section = section  # the section declaration line
+        self.type_line = None   # .type name,@function
+        self.size_line = None   # .size name, .Lfunc_endN-name
+
+    def traverse(self):
+        '''Lines of the function, without building a list'''
+        p = self.begin
+        while True:
+            yield p
+            if p is self.end:
+                return
+            p = p.next
+
+
+class SectionInfo():
+    '''Index of a section (by bare name). A section can be declared in many
+    places, each declaration begins a region which lasts until the next
+    section directive.'''
+    __slots__ = ('name', 'regions', 'labels', 'line_count', 'instruction_count', 'aligns')
+
+    def __init__(self, name):
+        self.name = name
+        self.regions = dict()  # declaration line -> None, as an ordered set
+        self.labels = dict()   # label line -> None
+        self.line_count = 0
+        self.instruction_count = 0
+        self.aligns = dict()   # log2 alignment -> number of align directives
+
+    @property
+    def max_align(self):
+        return max(self.aligns) if self.aligns else 0
+
+    def count(self, line, n):
+        '''Add (n=1) or remove (n=-1) a line of the section'''
+        self.line_count += n
+        if line.is_instruction:
+            self.instruction_count += n
+        elif line.is_label:
+            if n > 0:
+                self.labels[line] = None
+            else:
+                self.labels.pop(line, None)
+        elif line.is_directive:
+            if line.section_declaration is line:
+                if n > 0:
+                    self.regions[line] = None
+                else:
+                    self.regions.pop(line, None)
+            self.count_align(line, n)
+
+    def count_align(self, line, n):
+        align = line.get_align()
+        if align is not None:
+            self.aligns[align] = self.aligns.get(align, 0) + n
+            if not self.aligns[align]:
+                del self.aligns[align]
+
+    def traverse(self):
+        '''Lines of the section, region by region in the list order'''
+        for declare in sorted(self.regions, key=lambda line: line._order):
+            p = declare
+            while True:
+                yield p
+                p = p.next
+                if p is None or p.is_section_directive:
+                    break
+
+
+def cache_path_key(path):
+    '''The part of the parse cache name of the asm file at path: one cache is
+    kept for a file, see remove_old_caches'''
+    return hashlib.blake2b(os.fsencode(os.path.abspath(path)), digest_size=8).hexdigest()
+
+
+def remove_old_caches(cache_path):
+    '''Remove the other parse caches of the same file (path key) as
+    cache_path: of an older content or parser version. Other processes may
+    remove them too.'''
+    directory, name = os.path.split(cache_path)
+    key = name.split('.')[0]
+    for old_path in glob.glob(os.path.join(glob.escape(directory), key + '.*.asmcache')):
+        if old_path == cache_path:
+            continue
+        try:
+            os.remove(old_path)
+        except FileNotFoundError:
+            pass
+
+
+def split_path(path):
+    '''The components of a path, without the empty and '.' ones'''
+    return [part for part in path.split('/') if part and part != '.']
+
+
+class FileNumberTrie():
+    '''Resolve the file names of the CFG locations (e.g. src/a.c) to the
+    numbers of the DWARF .file directives. A name matches the .file paths it
+    is a suffix of, component by component. The trie is on the reversed
+    components, a lookup walks the name from its basename: O(path length).
+    A name matching different files, and the whole path of none of them, is
+    ambiguous: it is not resolved and it is recorded in self.ambiguous.'''
+    AMBIGUOUS = -1
+
+    def __init__(self, file_numbers=None):
+        # a node: [children: component -> node, the number of the files
+        #          below or AMBIGUOUS, the number of the file ending here]
+        self.root = [dict(), None, None]
+        self.ambiguous = set()
+        if file_numbers:
+            paths = dict()  # the same path written in different ways: the last one
+            for path, number in file_numbers.items():
+                paths[tuple(split_path(path))] = number
+            for parts, number in paths.items():
+                self.add(parts, number)
+
+    def add(self, parts, number):
+        node = self.root
+        for part in reversed(parts):
+            node[1] = number if node[1] in (None, number) else self.AMBIGUOUS
+            child = node[0].get(part)
+            if child is None:
+                child = node[0][part] = [dict(), None, None]
+            node = child
+        node[1] = number if node[1] in (None, number) else self.AMBIGUOUS
+        node[2] = number
+
+    def find_node(self, name):
+        node = self.root
+        for part in reversed(split_path(name)):
+            node = node[0].get(part)
+            if node is None:
+                return None
+        return node
+
+    def __getitem__(self, name):
+        '''The number of the file, a name which is a whole path is that file
+        even if it is a suffix of other paths too
+        >>> trie = FileNumberTrie({'a.c': 1, 'sub/a.c': 2, 'sub/b.c': 3})
+        >>> trie['a.c'], trie['sub/a.c'], trie['b.c']
+        (1, 2, 3)
+        '''
+        node = self.find_node(name)
+        if node is None:
+            raise KeyError(name)
+        if node[2] is not None:  # the whole path of a file
+            return node[2]
+        if name.startswith('/'):  # an absolute name matches the whole path only
+            raise KeyError(name)
+        number = node[1]
+        if number is None:
+            raise KeyError(name)
+        if number == self.AMBIGUOUS:
+            self.ambiguous.add(name)
+            raise KeyError(name)
+        return number
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def candidates(self, name):
+        '''The paths (as '/'.join of the components) matching the name'''
+        node = self.find_node(name)
+        if node is None:
+            return []
+        paths = []
+        stack = [(node, split_path(name))]
+        while stack:
+            node, parts = stack.pop()
+            if node[2] is not None:
+                paths.append('/'.join(parts))
+            for part, child in node[0].items():
+                stack.append((child, [part] + parts))
+        return sorted(paths)
+
+
 class AsmSrc(str):
     '''Bidirectional linked list.
     Traversing: use traverse_lines
+    Each line in the list has an order label (_order), increasing along the
+    list, kept by insert/unlink/move. Compare positions with is_before.
+    Edits are recorded in the journal: dirty_functions/dirty_sections tell
+    what was touched, rollback undoes them.
     '''
 
-    def __init__(self, s):
+    def __new__(cls, s='', *args, **kwargs):
+        return super(AsmSrc, cls).__new__(cls, s)
+
+    def __init__(self, s='', lines=None):
+        '''Build from the string s, or from an iterable of Lines (then the
+        monolithic string is never held, see read_file)'''
         super(AsmSrc, self).__init__()
-        self.lines = [Line(i) for i in self.split('\n')]
-        for index in range(len(self.lines)-1):
-            self.lines[index].next = self.lines[index+1]
-            self.lines[index+1].prev = self.lines[index]
-        self.HEAD = self.lines[0]
+        self.lines = []
+        self.HEAD = None
         self.label_name_to_line = dict()  # label->line
         self.label_list = []  # in order
         self.section_lines = []
+        self.sections = dict()      # bare name -> SectionInfo
+        self.declarations = dict()  # section directive -> SectionInfo
 
         self.functions = []   # name strings
+        self.function_extents = dict()  # name -> FunctionExtent
+        self.function_begins = dict()   # begin line -> FunctionExtent
         self.line_hash_index = dict()
 
         self.debug_file_number = dict()  # key: file value: number
-        current_section = None
-        current_loc = None
-        for line in self.lines:
-            # update file number
-            if line.is_debug_file_directive:
-                file_num, file_str = line.split()[1], line.split()[2]
-                self.debug_file_number[file_str.replace(
-                    '"', '')] = int(file_num)
-
-            if line.is_section_directive:
-                self.section_lines.append(line)
-                current_section = line
-            elif line.is_instruction:
-                line.set_section_declaration(current_section)
-
-            if line.is_directive and line.get_directive_type() == '.type':
-                args = line.strip_comment().replace('.type', '').strip()
-                function_name = args.split(',')[0].strip()
-                self.functions.append(function_name)
-
-            if line.is_label:
-                line.set_section_declaration(current_section)
+        self.file_number_trie = None  # see update_debug_file_number
+        self.journal = []  # edits after parsing, see rollback
+        self.source = None  # SourceFile, if read from a file
+        # parsing state, at the end of the parsed lines
+        self.current_section = None
+        self.current_loc = None
+        self.current_function = None  # FunctionExtent not ended yet
+        if lines is None:
+            lines = (Line(i) for i in super(AsmSrc, self).__str__().split('\n'))
+        self.parse_lines(lines)
+        # the key ids of the parsed lines, a line inserted later gets one of
+        # key_id instead, see own_line
+        keys = [line._key_id for line in self.lines]
+        self.parsed_keys = range(min(keys), max(keys)+1) if keys else range(0)
+        self.key_id = -1
+
+    def parse_lines(self, lines):
+        '''Append lines to the tail and index them, one by one'''
+        current_section = self.current_section
+        current_loc = self.current_loc
+        current_function = self.current_function
+        info = self.declarations.get(current_section)
+        tail = self.lines[-1] if self.lines else None
+        order = tail._order if tail is not None else -ORDER_GAP
+        for line in lines:
+            self.lines.append(line)
+            if tail is not None:
+                tail.next = line
+                line.prev = tail
+            tail = line
+            order += ORDER_GAP
+            line._order = order
+            # dispatch on the cached type, do not re-tokenize the line
+            if line.is_instruction:
+                line.section_declaration = current_section
+                line.set_loc(current_loc)
+                if info is not None:
+                    info.line_count += 1
+                    info.instruction_count += 1
+            elif line.is_label:
+                line.section_declaration = current_section
                 self.label_list.append(line)
                 self.label_name_to_line[line.get_label()] = line
-
-            if line.is_loc_directive:
-                current_loc = line.get_loc
-            elif line.is_instruction:
-                line.set_loc(current_loc)
+                if info is not None:
+                    info.line_count += 1
+                    info.labels[line] = None
+            elif line.is_directive:
+                if line.is_section_directive:
+                    self.section_lines.append(line)
+                    current_section = line
+                    info = self.declare_section(line)
+                line.section_declaration = current_section
+                if info is not None:
+                    info.line_count += 1
+                    if line is current_section:
+                        info.regions[line] = None
+                    elif line._word in ALIGN_DIRECTIVES:
+                        info.count_align(line, 1)
+                if line.is_loc_directive:
+                    current_loc = line.get_loc
+                elif line.get_directive_type() == '.type':
+                    function_name = line.get_operands().split(',')[0].strip()
+                    self.functions.append(function_name)
+                    if current_function and current_function.name == function_name:
+                        current_function.type_line = line
+                elif line.get_directive_type() == '.size':
+                    if current_function and current_function.name == \
+                            line.get_operands().split(',')[0].strip():
+                        current_function.size_line = line
+                elif line.is_debug_file_directive:
+                    # update file number
+                    file_num, file_str = line.get_operands().split()[:2]
+                    self.debug_file_number[file_str.replace(
+                        '"', '')] = int(file_num)
+            else:
+                line.section_declaration = current_section
+                if info is not None:
+                    info.line_count += 1
+            # function begin/end marks are in the comments
+            if line._code_end < len(line):
+                comment = line.get_comment()
+                if '# -- Begin function' in comment:
+                    begin = line
+                    if line.prev is not None and line.prev.is_section_directive:
+                        begin = line.prev
+                    current_function = FunctionExtent(
+                        comment.split('Begin function', 1)[1].strip(), begin, current_section)
+                elif '# -- End function' in comment and current_function:
+                    current_function.end = line
+                    self.function_extents[current_function.name] = current_function
+                    self.function_begins[current_function.begin] = current_function
+                    current_function = None
+        self.current_section = current_section
+        self.current_loc = current_loc
+        self.current_function = current_function
+        if self.lines:
+            self.HEAD = self.lines[0]
 
     def __str__(self):
-        output = ''
+        return ''.join([str(line)+'\n' for line in self.traverse_lines()])
+
+    def write_to(self, path_or_fd, buffer_size=1 << 20):
+        '''Write the asm to a path, a fd or a binary file object.
+        Untouched lines read from a file are copied as slices of the source
+        file, only the lines changed by set_str or inserted are rendered.
+        Output is batched into buffers of buffer_size bytes.'''
+        if isinstance(path_or_fd, int):
+            with os.fdopen(path_or_fd, 'wb', closefd=False) as f:
+                return self.write_to(f, buffer_size)
+        if not hasattr(path_or_fd, 'write'):
+            source = self.source
+            if source and source.is_same_file(path_or_fd):
+                self.source = None  # do not copy from the file we truncate
+            try:
+                with open(path_or_fd, 'wb') as f:
+                    return self.write_to(f, buffer_size)
+            finally:
+                self.source = source
+        f = path_or_fd
+
+        source = self.source if self.source and self.source.is_unchanged() else None
+        buf = []
+        buf_size = 0
+        run_start = run_end = None  # a run of untouched, continuous lines
         for line in self.traverse_lines():
-            output += str(line)+'\n'
-        return output
+            start = line._src if source and line.new_str is None else None
+            if start is not None and start == run_end and run_end-run_start < buffer_size:
+                run_end += line.byte_length+1
+                continue
+            if run_end is not None:
+                buf.append(source.slice(run_start, run_end))
+                buf_size += run_end-run_start
+                run_start = run_end = None
+            if start is not None:
+                run_start, run_end = start, start+line.byte_length+1
+            else:
+                data = (str(line)+'\n').encode()
+                buf.append(data)
+                buf_size += len(data)
+            if buf_size >= buffer_size:
+                f.write(b''.join(buf))
+                buf = []
+                buf_size = 0
+        if run_end is not None:
+            buf.append(source.slice(run_start, run_end))
+        f.write(b''.join(buf))
 
     def traverse_lines(self):
         p = self.HEAD
@@ -233,25 +702,11 @@ class AsmSrc(str):
             p = p.prev
         yield p
 
-    def update_debug_file_number(self, path):
-        # we add more keys to the debug_file_number to facilitate the mapping
-        if not path:
-            return
-        for key in [k for k in self.debug_file_number.keys()]:
-            new_key = key.replace(path, '')
-            self.debug_file_number[new_key] = self.debug_file_number[key]
-        for key in [k for k in self.debug_file_number.keys()]:
-            if key.startswith('.'):
-                new_key = key.replace('.', '')
-                self.debug_file_number[new_key] = self.debug_file_number[key]
-
-        # we add the single file name without name as the key too,
-        # in some big programs, this is required
-        # but, this may cause conflict, as different path may have same file name
-        for key in [k for k in self.debug_file_number.keys()]:
-            if '/' in key:
-                new_key = key.split('/')[-1]
-                self.debug_file_number[new_key] = self.debug_file_number[key]
+    def update_debug_file_number(self, path=''):
+        '''Build the FileNumberTrie of the .file directives, the CFG file names
+        are resolved by it. path (the source directory) is not needed, a name
+        matches the paths it is a suffix of.'''
+        self.file_number_trie = FileNumberTrie(self.debug_file_number)
 
     def get_file_numbers(self):
         return self.debug_file_number
@@ -264,17 +719,93 @@ class AsmSrc(str):
             logger.debug('label %s not found' % label)
             return None
 
+    def own_line(self, line):
+        '''Give a line new to the list a key id of this AsmSrc (negative,
+        counting down). The ids are unique in the list and do not depend on
+        the lines made elsewhere; they are never reused, also not after a
+        rollback.'''
+        if line._key_id >= 0 and line._key_id not in self.parsed_keys:
+            line._key_id = self.key_id
+            self.key_id -= 1
+
     def insert_before(self, insert_line, before_line):
+        self.own_line(insert_line)
+        self.link_before(insert_line, before_line)
+        self.journal.append(('insert', insert_line, None))
+
+    def insert_after(self, insert_line, after_line):
+        self.own_line(insert_line)
+        self.link_after(insert_line, after_line)
+        self.journal.append(('insert', insert_line, None))
+
+    def link_before(self, insert_line, before_line):
         insert_line.next = before_line
         insert_line.prev = before_line.prev
-        insert_line.prev.next = insert_line
+        if insert_line.prev is not None:
+            insert_line.prev.next = insert_line
+        else:
+            self.HEAD = insert_line
         before_line.prev = insert_line
+        self.update_order(insert_line)
+        self.update_section_link(insert_line)
 
-    def insert_after(self, insert_line, after_line):
+    def link_after(self, insert_line, after_line):
         insert_line.prev = after_line
         insert_line.next = after_line.next
-        insert_line.next.prev = insert_line
+        if insert_line.next is not None:
+            insert_line.next.prev = insert_line
         after_line.next = insert_line
+        self.update_order(insert_line)
+        self.update_section_link(insert_line)
+
+    def update_order(self, line):
+        '''Give a just linked line an order label between its neighbours'''
+        lo = line.prev._order if line.prev is not None else None
+        hi = line.next._order if line.next is not None else None
+        if lo is None and hi is None:
+            line._order = 0
+        elif lo is None:
+            line._order = hi - ORDER_GAP
+        elif hi is None:
+            line._order = lo + ORDER_GAP
+        elif hi - lo > 1:
+            line._order = (lo+hi) // 2
+        else:
+            self.relabel_order(line)
+
+    def relabel_order(self, line, last=None, count=1):
+        '''No room between the neighbours: grow a window around the line until
+        the labels around it are sparse enough, then spread the window evenly.
+        The whole list is relabeled only if the window reaches both ends.
+        last, count: relabel the count lines line..last instead'''
+        start, end = line, last if last is not None else line
+        while True:
+            for _ in range(count):
+                if start.prev is not None:
+                    start = start.prev
+                    count += 1
+                if end.next is not None:
+                    end = end.next
+                    count += 1
+            lo = start.prev._order if start.prev is not None else None
+            hi = end.next._order if end.next is not None else None
+            if lo is None and hi is None:
+                lo, hi = -ORDER_GAP, count*ORDER_GAP
+            elif lo is None:
+                lo = hi - (count+1)*ORDER_GAP
+            elif hi is None:
+                hi = lo + (count+1)*ORDER_GAP
+            gap = (hi-lo) // (count+1)
+            if gap > count:
+                break
+        p = start
+        for i in range(1, count+1):
+            p._order = lo + i*gap
+            p = p.next
+
+    def is_before(self, line, other):
+        '''O(1): whether line is before other in the list'''
+        return line._order < other._order
 
     def insert_lines_before(self, lines, before_line):
         for line in lines:
@@ -285,18 +816,194 @@ class AsmSrc(str):
             self.insert_after(line, after_line)
 
     def unlink_line(self, line):
-        line.prev.next = line.next
-        line.next.prev = line.prev
+        self.journal.append(('unlink', line, line.prev))
+        self.unlink(line)
+
+    def unlink(self, line, reassign=True):
+        '''reassign: the lines after a section directive join the section
+        before it, False if they get their place back later (see rollback)'''
+        if reassign:
+            self.update_section_unlink(line)
+        else:
+            self.count_section_line(line, -1)
+        if line.prev is not None:
+            line.prev.next = line.next
+        else:
+            self.HEAD = line.next
+        if line.next is not None:
+            line.next.prev = line.prev
+        line._order = None
+
+    # section index
+    def declare_section(self, line):
+        '''Register a section directive, return its SectionInfo'''
+        name = line.get_bare_section()
+        try:
+            info = self.sections[name]
+        except KeyError:
+            info = self.sections[name] = SectionInfo(name)
+        self.declarations[line] = info
+        return info
+
+    def get_section_info(self, name):
+        return self.sections.get(name)
+
+    def traverse_section(self, name):
+        '''O(section size): the lines of all the regions of a section'''
+        return self.sections[name].traverse()
+
+    def count_section_line(self, line, n):
+        info = self.declarations.get(line.section_declaration)
+        if info is not None:
+            info.count(line, n)
+
+    def same_section(self, declaration, other):
+        '''Whether two section directives (or None) declare the same section'''
+        return declaration is other or (
+            self.declarations.get(declaration) is self.declarations.get(other))
+
+    # section_declaration of a line is a directive of its section, not always
+    # the nearest one before it: the lines of a region share the section, so
+    # a region is walked only when its section really changes.
+    def reassign_section(self, line, section):
+        '''The lines after line, until the next section directive, are in
+        section now'''
+        self.assign_region(line.next, section)
+
+    def assign_region(self, line, section):
+        '''The lines from line until the next section directive are in
+        section now'''
+        p = line
+        if p is None or p.is_section_directive or self.same_section(p.section_declaration, section):
+            return  # the whole region is in it already
+        while p is not None and not p.is_section_directive:
+            self.count_section_line(p, -1)
+            p.section_declaration = section
+            self.count_section_line(p, 1)
+            p = p.next
+
+    def update_section_link(self, line):
+        '''A linked line belongs to the section before it, a linked
+        section directive takes the lines after it'''
+        if line.is_section_directive:
+            if line not in self.declarations:
+                self.declare_section(line)
+            line.section_declaration = line
+            self.reassign_section(line, line)
+        else:
+            line.section_declaration = (line.prev.section_declaration
+                                        if line.prev is not None else None)
+        self.count_section_line(line, 1)
+
+    def update_section_unlink(self, line):
+        self.count_section_line(line, -1)
+        if line.is_section_directive:
+            self.reassign_section(line, line.prev.section_declaration
+                                  if line.prev is not None else None)
+
+    def set_str(self, line, s):
+        '''Replace the text of a line, use this instead of line.set_str to
+        keep the journal'''
+        self.journal.append(('set_str', line, line.new_str))
+        line.set_str(s)
+
+    # edit journal
+    # every insert/unlink/set_str/splice is recorded as (op, line, old value), so
+    # the touched regions can be found later and the edits can be undone.
+    def checkpoint(self):
+        '''A mark of the current state, for rollback'''
+        return len(self.journal)
+
+    def rollback(self, checkpoint=0):
+        '''Undo the edits after the checkpoint, the latest first'''
+        while len(self.journal) > checkpoint:
+            op, line, old = self.journal.pop()
+            if op == 'insert':
+                self.unlink(line)
+            elif op == 'unlink':
+                self.link_after(line, old)
+            elif op == 'set_str':
+                line.new_str = old
+            elif op == 'declare':  # added by a splice, undone with it
+                self.unlink(line, reassign=False)
+            elif op == 'splice':
+                last, src_prev, dst_next = old
+                self.relink(line, last, src_prev)
+                for p in (line, last.next, dst_next):
+                    self.fit_section(p)
+            elif op == 'begin':  # line is a FunctionExtent here
+                self.function_begins.pop(line.begin, None)
+                line.begin = old
+                self.function_begins[old] = line
+
+    def journal_anchors(self, checkpoint=0):
+        '''Lines in the list where the edits after the checkpoint happened.
+        For a removed line, it is the line before the gap it left.'''
+        anchors = []
+        for op, line, old in self.journal[checkpoint:]:
+            if op == 'begin':
+                lines = (line.begin,)
+            elif op == 'unlink':
+                lines = (old,)
+            elif op == 'splice':  # the block and the gap it left
+                lines = (line, old[1])
+            else:
+                lines = (line,)
+            for line in lines:
+                while line is not None and line._order is None:
+                    line = line.prev  # removed later too, follow the old links
+                if line is not None:
+                    anchors.append(line)
+        return anchors
+
+    def locate_function(self, line, memo, function_ends):
+        '''The FunctionExtent containing the line, or None. Walks back to the
+        begin of the function, the lines walked through are memorized.'''
+        walked = []
+        p = line
+        function = None
+        while p is not None:
+            if p in self.function_begins:
+                function = self.function_begins[p]
+                break
+            if p is not line and p in function_ends:
+                break  # after the end of a function
+            if p in memo:
+                function = memo[p]
+                break
+            walked.append(p)
+            p = p.prev
+        for p in walked:
+            memo[p] = function
+        return function
+
+    def dirty_functions(self, checkpoint=0):
+        '''Names of the functions touched after the checkpoint'''
+        memo = dict()
+        function_ends = {f.end for f in self.function_extents.values()}
+        dirty = set()
+        for line in self.journal_anchors(checkpoint):
+            function = self.locate_function(line, memo, function_ends)
+            if function is not None:
+                dirty.add(function.name)
+        return dirty
+
+    def dirty_sections(self, checkpoint=0):
+        '''Bare names of the sections touched after the checkpoint'''
+        dirty = set()
+        for line in self.journal_anchors(checkpoint):
+            info = self.declarations.get(line.section_declaration)
+            if info is not None:
+                dirty.add(info.name)
+        return dirty
 
     def del_line(self, line):
         del line
 
     def sort_lines(self, lines):
-        new_lst = []
-        for line in self.traverse_lines():
-            if line in lines:
-                new_lst.append(line)
-        return new_lst
+        '''Lines in the list order, lines not in the list are dropped'''
+        return sorted({line for line in lines if line._order is not None},
+                      key=lambda line: line._order)
 
     def move_lines_before(self, line_lst, before_line):
         for line in line_lst:
@@ -318,9 +1025,18 @@ class AsmSrc(str):
                     self.insert_after(line, last_one)
                 last_one = line
 
+    def get_function(self, function_name):
+        '''O(1): the FunctionExtent recorded while parsing, or None'''
+        return self.function_extents.get(function_name)
+
+    def traverse_function(self, function_name):
+        return self.function_extents[function_name].traverse()
+
     def get_function_lines(self, function_name, speculate='clang debug'):
         # guess function beginning/ending is not reliable
         # so use arg speculate to use different speculate information
+        if speculate == 'clang debug' and function_name in self.function_extents:
+            return list(self.function_extents[function_name].traverse())
         if speculate == 'clang debug':
             begin_line = end_line = self.find_label(function_name)
 
@@ -342,32 +1058,622 @@ class AsmSrc(str):
                 p = p.next
             return function
 
-    # move lines and repair the section declaration
+    # move functions by splicing: the lines are relinked as a block, only the
+    # order labels of the block are updated, and a section directive is added
+    # where a region would change its section (see keep_section)
     def move_function_before(self, lines, before_line):
-        self.move_lines_before(lines, before_line)
-        for line in lines:
-            if line.is_section_directive:
-                return  # exist a section declaration
-            if line.is_instruction:
-                declare = copy.deepcopy(line.section_declaration)
-                self.insert_before(declare, lines[0])
+        self.splice(lines[0], lines[-1], before_line.prev)
 
     def move_function_after(self, lines, after_line):
-        self.move_lines_after(lines, after_line)
-        for line in lines:
-            if line.is_section_directive:
-                return  # exist a section declaration
-            if line.is_instruction:
-                declare = copy.deepcopy(line.section_declaration)
-                self.insert_before(declare, lines[0])
+        self.splice(lines[0], lines[-1], after_line)
+
+    def move_extent_before(self, function, before_line):
+        '''function: a FunctionExtent (or its name)'''
+        if not isinstance(function, FunctionExtent):
+            function = self.function_extents[function]
+        self.splice(function.begin, function.end, before_line.prev)
+
+    def move_extent_after(self, function, after_line):
+        if not isinstance(function, FunctionExtent):
+            function = self.function_extents[function]
+        self.splice(function.begin, function.end, after_line)
+
+    def reorder_functions(self, names, before_line=None):
+        '''Apply a reorder plan in one pass: the functions are put together,
+        in the order of names, before before_line (default: where the first
+        one is). E.g. hot/cold grouping: names = hot functions + cold ones.'''
+        extents = [self.function_extents[name] for name in names]
+        if not extents:
+            return
+        after = before_line.prev if before_line is not None else extents[0].begin.prev
+        for function in extents:  # after is None: at the head
+            if function.begin is not (after.next if after is not None else self.HEAD):
+                self.splice(function.begin, function.end, after)
+            after = function.end
+
+    def splice(self, first, last, after_line):
+        '''Move the lines first..last after after_line (None: to the head).
+        The moved lines, and the lines left behind them at both ends, stay in
+        their sections: a section directive is added where the section would
+        change. O(moved lines), the regions around are not walked.'''
+        dst_next = after_line.next if after_line is not None else self.HEAD
+        if after_line is last or dst_next is first:
+            return
+        p = first
+        while p is not last.next:
+            if p is after_line:
+                raise ValueError('cannot move lines into themselves')
+            p = p.next
+        src_prev, src_next = first.prev, last.next
+        sections = [(line, line.section_declaration) for line in (first, src_next, dst_next)
+                    if line is not None]
+        self.relink(first, last, after_line)
+        self.journal.append(('splice', first, (last, src_prev, dst_next)))
+        for line, section in sections:
+            self.keep_section(line, section)
+
+    def relink(self, first, last, after_line):
+        '''The splice itself, not journaled: the links and the order labels
+        of the moved lines, the sections are left to the caller'''
+        src_prev, src_next = first.prev, last.next
+        if src_prev is not None:
+            src_prev.next = src_next
+        else:
+            self.HEAD = src_next
+        if src_next is not None:
+            src_next.prev = src_prev
+        dst_next = after_line.next if after_line is not None else self.HEAD
+        first.prev, last.next = after_line, dst_next
+        if dst_next is not None:
+            dst_next.prev = last
+        if after_line is not None:
+            after_line.next = first
+        else:
+            self.HEAD = first
+        self.label_order(first, last)
+
+    def fit_section(self, line):
+        '''The region from line joins the section before it, if it is not
+        there (O(1) if it is)'''
+        if line is not None and not line.is_section_directive:
+            self.assign_region(line, line.prev.section_declaration
+                               if line.prev is not None else None)
+
+    def label_order(self, first, last):
+        '''Give the linked lines first..last order labels between their
+        neighbours'''
+        count = 1
+        p = first
+        while p is not last:
+            p = p.next
+            count += 1
+        lo = first.prev._order if first.prev is not None else None
+        hi = last.next._order if last.next is not None else None
+        if lo is None and hi is None:
+            lo, hi = -ORDER_GAP, count*ORDER_GAP
+        elif lo is None:
+            lo = hi - (count+1)*ORDER_GAP
+        elif hi is None:
+            hi = lo + (count+1)*ORDER_GAP
+        gap = (hi-lo) // (count+1)
+        if gap < 1:
+            self.relabel_order(first, last, count)
+            return
+        p = first
+        for i in range(1, count+1):
+            p._order = lo + i*gap
+            p = p.next
+
+    def keep_section(self, line, section):
+        '''After a splice, the line and the rest of its region should still be
+        in section: if they are not, and the region has something other than
+        empty lines and comments, declare the section again before the line.
+        The lines keep their section_declaration then. Otherwise they join
+        the section before them (the region is walked, it is only comments).'''
+        if line is None or line.is_section_directive:
+            return
+        current = line.prev.section_declaration if line.prev is not None else None
+        if self.same_section(current, section):
+            return
+        p = line
+        while p is not None and not (p.is_instruction or p.is_label or p.is_directive):
+            p = p.next
+        if section is None or p is None or p.is_section_directive:
+            self.assign_region(line, current)
+            return
+        declare = Line('\t' + section.strip_comment())
+        self.link_before(declare, line)
+        self.journal.append(('declare', declare, None))
+        # a function beginning at the line begins with the declaration now
+        function = self.function_begins.pop(line, None)
+        if function:
+            self.journal.append(('begin', function, function.begin))
+            function.begin = declare
+            self.function_begins[declare] = function
 
     def get_sections(self):
         return [line.get_section() for line in self.section_lines]
 
     @classmethod
-    def read_file(cls, path, src_path=''):
+    def read_file(cls, path, src_path='', cache_dir=None, processes=1):
+        '''cache_dir: load the parsed form from a cache in this directory if the
+        content and the parser version match, or parse and write it
+        processes > 1: parse ranges of the file in a process pool, see
+        parse_parallel, the result is the same as the serial parse'''
         logger.info('Loading %s' % path)
-        with open(path) as f:
-            asm = cls(f.read())
-            asm.update_debug_file_number(src_path)
-            return asm
+        source = SourceFile(path)
+        cache_path = None
+        if cache_dir is not None and source.map is not None:
+            cache_path = os.path.join(cache_dir, '%s.%s.%d.asmcache' % (
+                cache_path_key(path), source.content_hash().hex(), PARSER_VERSION))
+            asm = cls.load_cache(cache_path, source)
+            if asm is not None:
+                logger.info('Loaded from cache %s' % cache_path)
+                asm.update_debug_file_number(src_path)
+                return asm
+
+        asm = None
+        if processes > 1 and source.map is not None:
+            asm = cls.parse_parallel(source, processes)
+        if asm is None:
+            def lines():
+                for offset, s in source.read_lines():
+                    line = Line(s)
+                    line._src = offset
+                    yield line
+            asm = cls(lines=lines())
+            asm.source = source
+        if cache_path is not None and asm.dump_cache(cache_path):
+            try:
+                remove_old_caches(cache_path)
+            except OSError as e:
+                logger.warning('Cannot remove the old caches of %s: %s' % (path, e))
+        asm.update_debug_file_number(src_path)
+        return asm
+
+    @classmethod
+    def parse_parallel(cls, source, processes):
+        '''Parse the ranges of source.split_points by parse_range in a pool,
+        join them by stitch_cache_blocks and build the lines from the joined
+        blocks like load_cache. None if the ranges cannot be joined.'''
+        points = source.split_points(processes)
+        tasks = [(source.path, start, end) for start, end in zip(points, points[1:])]
+        if len(tasks) < 2:
+            return None
+        with multiprocessing.Pool(min(processes, len(tasks))) as pool:
+            parts = pool.map(parse_range, tasks)
+        blocks = stitch_cache_blocks(parts) if None not in parts else None
+        if blocks is None:
+            logger.info('Cannot join the parsed ranges of %s, parsing it serially' % source.path)
+            return None
+        return cls.from_cache_blocks(blocks, source)
+
+    # parse cache
+    # the parsed form of a file: the fields of the lines and the indexes, as
+    # arrays of ints in a binary file, lines are referred by their index.
+    # The text of the lines is still read from the asm file.
+    def dump_cache(self, path):
+        '''Write the parsed form, only valid right after parsing (the lines
+        are numbered by their order labels). Return whether it is written.'''
+        blocks = self.cache_blocks()
+        if blocks is None:
+            return False
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(CACHE_HEADER.pack(CACHE_MAGIC, PARSER_VERSION,
+                                          self.source.content_hash(), len(self.lines)))
+                for block in blocks:
+                    f.write(CACHE_BLOCK.pack(block.typecode.encode(), len(block)))
+                    block.tofile(f)
+                    f.write(b'\0' * (-f.tell() % 8))
+            os.replace(tmp_path, path)
+            return True
+        except OSError as e:
+            logger.warning('Cannot write the cache %s: %s' % (path, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+    def cache_blocks(self):
+        '''The arrays of the parsed form, see dump_cache, None if a Line slot
+        would be lost'''
+        first_lines = {line.type: line for line in reversed(self.lines)}.values()
+        unknown = {slot for line in first_lines for slot in Line.__slots__
+                   if slot not in LINE_CACHE_SLOTS + LINE_LOAD_SLOTS and hasattr(line, slot)}
+        if unknown:  # a slot set while parsing, the cache would lose it
+            logger.warning('Not cached, Line slots not in LINE_CACHE_SLOTS: %s' % ', '.join(sorted(unknown)))
+            return False
+        strings = dict()  # string -> id
+
+        def sid(s):
+            try:
+                return strings[s]
+            except KeyError:
+                strings[s] = len(strings)
+                return strings[s]
+
+        def index(line):
+            return line._order // ORDER_GAP if line is not None else -1
+
+        locs = dict()  # packed loc -> id
+
+        def loc_id(loc):
+            if loc is None:
+                return -1
+            try:
+                return locs[loc]
+            except KeyError:
+                locs[loc] = len(locs)
+                return locs[loc]
+
+        lines = self.lines
+        type_codes = {t: i for i, t in enumerate(LINE_TYPES)}
+        extents = list(self.function_extents.values())
+        if self.current_function is not None:
+            extents.append(self.current_function)
+        state = array.array('i', [index(self.current_section), loc_id(self.current_loc),
+                                  len(extents)-1 if self.current_function is not None else -1])
+        encode = {  # slot -> typecode, the value in the array
+            'type': ('B', lambda line: type_codes[line.type]),
+            '_word': ('i', lambda line: sid(line._word) if line._word is not None else -1),
+            '_args': ('I', lambda line: line._args),
+            '_code_end': ('I', lambda line: line._code_end),
+            'section_declaration': ('i', lambda line: index(line.section_declaration)),
+            'loc': ('i', lambda line: loc_id(line.loc)),
+        }
+        blocks = [None]  # strings, filled at last
+        for slot in LINE_CACHE_SLOTS:
+            typecode, value = encode[slot]
+            blocks.append(array.array(typecode, map(value, lines)))
+        blocks += [
+            array.array('I', [x for loc in locs for x in unpack_loc(loc)]),
+            array.array('i', [index(line) for line in self.label_list]),
+            array.array('i', [index(line) for line in self.section_lines]),
+            array.array('i', [sid(name) for name in self.functions]),
+            array.array('i', [x for f in extents for x in (
+                sid(f.name), index(f.begin), index(f.end), index(f.section),
+                index(f.type_line), index(f.size_line))]),
+            array.array('i', [x for item in self.debug_file_number.items()
+                              for x in (sid(item[0]), item[1])]),
+            state,
+        ]
+        blocks[0] = array.array('B', '\n'.join(strings).encode())
+        return blocks
+
+    @classmethod
+    def load_cache(cls, path, source):
+        '''Build from a cache written by dump_cache, None if there is no
+        cache, or it is of another content or parser version'''
+        try:
+            with open(path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            return None
+        with mm:
+            try:
+                magic, version, digest, n = CACHE_HEADER.unpack_from(mm)
+            except struct.error:
+                return None
+            if (magic, version, digest) != (CACHE_MAGIC, PARSER_VERSION, source.content_hash()):
+                return None
+            blocks = []
+            offset = CACHE_HEADER.size
+            try:
+                with memoryview(mm) as view:
+                    while offset < len(mm):
+                        typecode, length = CACHE_BLOCK.unpack_from(mm, offset)
+                        typecode = typecode.decode()
+                        offset += CACHE_BLOCK.size
+                        size = length*array.array(typecode).itemsize
+                        with view[offset:offset+size] as data, data.cast(typecode) as block:
+                            blocks.append(block.tolist())
+                        offset += size + (-(offset+size) % 8)
+            except (struct.error, ValueError, TypeError):
+                blocks = None
+        asm = None
+        if blocks is not None and len(blocks) == 8 + len(LINE_CACHE_SLOTS) and len(blocks[1]) == n:
+            asm = cls.from_cache_blocks(blocks, source)
+        if asm is None:
+            logger.warning('Broken cache %s' % path)
+        return asm
+
+    @classmethod
+    def from_cache_blocks(cls, blocks, source):
+        '''Build from the blocks of cache_blocks (arrays or lists) and the
+        text of source, None if the lines do not fit'''
+        n = len(blocks[1])
+        strings = blocks[0]
+        slot_blocks = dict(zip(LINE_CACHE_SLOTS, blocks[1:]))
+        (loc_table, label_list, section_lines, functions, extents, file_numbers,
+         state) = blocks[1+len(LINE_CACHE_SLOTS):]
+        strings = [sys.intern(s) for s in bytes(strings).decode().split('\n')]
+        locs = [pack_loc(*loc_table[i:i+3]) for i in range(0, len(loc_table), 3)]
+
+        asm = cls(lines=())
+        lines = asm.lines
+        append = lines.append
+        new = str.__new__  # Line.__new__ without the python call
+        key = Line.key_id
+        prev = None
+        order = 0
+        # the lines are all alive, collecting while building them is useless
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for offset, s in source.read_lines():  # LINE_LOAD_SLOTS
+                line = new(Line, s)
+                line._key_id = key
+                key += 1
+                line.prev = prev
+                line.next = None
+                if prev is not None:
+                    prev.next = line
+                append(line)
+                line.new_str = None
+                line._src = offset
+                line._order = order
+                order += ORDER_GAP
+                prev = line
+            if len(lines) != n:  # the lines do not fit, should not happen
+                return None
+            decode = {  # slot -> the value from the array, None: as it is
+                'type': LINE_TYPES.__getitem__,
+                '_word': lambda w: strings[w] if w >= 0 else None,
+                '_args': None,
+                '_code_end': None,
+                'section_declaration': lambda i: lines[i] if i >= 0 else None,
+                'loc': lambda i: locs[i] if i >= 0 else None,
+            }
+            for slot in LINE_CACHE_SLOTS:
+                values = slot_blocks[slot]
+                if decode[slot] is not None:
+                    values = map(decode[slot], values)
+                collections.deque(map(getattr(Line, slot).__set__, lines, values), maxlen=0)
+        finally:
+            if gc_enabled:
+                gc.enable()
+            asm.parsed_keys = range(Line.key_id, key)
+            Line.key_id = key
+
+        # indexes
+        asm.label_list = [lines[i] for i in label_list]
+        for line in asm.label_list:
+            asm.label_name_to_line[line._word] = line
+        asm.section_lines = [lines[i] for i in section_lines]
+        for line in asm.section_lines:
+            asm.declare_section(line).regions[line] = None
+        for i, count in collections.Counter(slot_blocks['section_declaration']).items():
+            if i >= 0:
+                asm.declarations[lines[i]].line_count += count
+        instruction = LINE_TYPES.index('instruction')
+        is_instruction = bytes(int(t == instruction) for t in range(256))  # translate table
+        for i, count in collections.Counter(itertools.compress(
+                slot_blocks['section_declaration'], bytes(slot_blocks['type']).translate(is_instruction))).items():
+            if i >= 0:
+                asm.declarations[lines[i]].instruction_count += count
+        for line in asm.label_list:
+            if line.section_declaration is not None:
+                asm.declarations[line.section_declaration].labels[line] = None
+        align_words = {strings.index(w) for w in ALIGN_DIRECTIVES if w in strings}
+        for i in itertools.compress(range(len(lines)), map(align_words.__contains__, slot_blocks['_word'])):
+            if lines[i].section_declaration is not None:
+                asm.declarations[lines[i].section_declaration].count_align(lines[i], 1)
+        asm.functions = [strings[i] for i in functions]
+        function_list = []
+        for i in range(0, len(extents), 6):
+            name, begin, end, section, type_line, size_line = extents[i:i+6]
+            f = FunctionExtent(strings[name], lines[begin], lines[section] if section >= 0 else None)
+            f.end = lines[end] if end >= 0 else None
+            f.type_line = lines[type_line] if type_line >= 0 else None
+            f.size_line = lines[size_line] if size_line >= 0 else None
+            function_list.append(f)
+            if f.end is not None:
+                asm.function_extents[f.name] = f
+                asm.function_begins[f.begin] = f
+        for i in range(0, len(file_numbers), 2):
+            asm.debug_file_number[strings[file_numbers[i]]] = file_numbers[i+1]
+        current_section, current_loc, current_function = state
+        asm.current_section = lines[current_section] if current_section >= 0 else None
+        asm.current_loc = locs[current_loc] if current_loc >= 0 else None
+        asm.current_function = function_list[current_function] if current_function >= 0 else None
+        asm.HEAD = lines[0] if lines else None
+        asm.source = source
+        return asm
+
+
+def parse_range(task):
+    '''Parse the byte range [start, end) of an asm file, in a worker of
+    AsmSrc.parse_parallel. Return the blocks of cache_blocks, the lines are
+    numbered from the start of the range and the state before it is unknown
+    (see stitch_cache_blocks).'''
+    path, start, end = task
+    source = SourceFile(path)
+    try:
+        lines = [Line(s) for _, s in source.read_lines(start=start, end=end)]
+        if end < len(source.map):
+            lines.pop()  # '' after the last newline, the next range goes on
+        return AsmSrc(lines=lines).cache_blocks()
+    finally:
+        source.close()
+
+
+def stitch_cache_blocks(parts):
+    '''Join the blocks of parse_range of consecutive ranges into the blocks of
+    the whole file. A range starts in the section and at the loc where the
+    previous one ends. None if a range ends in a function or right after a
+    section directive: the serial parse would carry them over.'''
+    k = len(LINE_CACHE_SLOTS)
+    instruction = LINE_TYPES.index('instruction')
+    strings = dict()  # string -> id
+    slot_blocks = {slot: [] for slot in LINE_CACHE_SLOTS}
+    loc_table, label_list, section_lines, functions, extents, file_numbers = [], [], [], [], [], []
+    section, loc, function = -1, -1, -1  # the state at the end of the ranges so far
+    base = 0  # index of the first line of the range
+    for part in parts:
+        if function >= 0 or (section_lines and section_lines[-1] == base-1):
+            return None
+        remap = [strings.setdefault(x, len(strings)) for x in bytes(part[0]).decode().split('\n')]
+        types, words, args, code_ends, sections, locs = part[1:1+k]
+        (part_loc_table, part_labels, part_sections, part_functions, part_extents,
+         part_file_numbers, part_state) = part[1+k:]
+        loc_base = len(loc_table) // 3
+        extent_base = len(extents) // 6
+
+        def index(i):
+            return i + base if i >= 0 else -1
+
+        def section_index(i):  # -1: before the first section directive of the range
+            return i + base if i >= 0 else section
+        slot_blocks['type'] += types
+        slot_blocks['_word'] += [remap[w] if w >= 0 else -1 for w in words]
+        slot_blocks['_args'] += args
+        slot_blocks['_code_end'] += code_ends
+        slot_blocks['section_declaration'] += map(section_index, sections)
+        slot_blocks['loc'] += [i + loc_base if i >= 0 else loc if t == instruction else -1
+                               for i, t in zip(locs, types)]
+        loc_table += part_loc_table
+        label_list += map(index, part_labels)
+        section_lines += map(index, part_sections)
+        functions += [remap[i] for i in part_functions]
+        for i in range(0, len(part_extents), 6):
+            name, begin, end, extent_section, type_line, size_line = part_extents[i:i+6]
+            extents += [remap[name], index(begin), index(end), section_index(extent_section),
+                        index(type_line), index(size_line)]
+        for i in range(0, len(part_file_numbers), 2):
+            file_numbers += [remap[part_file_numbers[i]], part_file_numbers[i+1]]
+        part_section, part_loc, part_function = part_state
+        section = section_index(part_section)
+        loc = part_loc + loc_base if part_loc >= 0 else loc
+        function = part_function + extent_base if part_function >= 0 else -1
+        base += len(types)
+    return ([array.array('B', '\n'.join(strings).encode())] +
+            [slot_blocks[slot] for slot in LINE_CACHE_SLOTS] +
+            [loc_table, label_list, section_lines, functions, extents, file_numbers,
+             [section, loc, function]])
+
+
+class SourceFile():
+    '''A read only asm file. It is mmaped (if possible) and kept mapped, so
+    the untouched lines can be written back as slices of it.'''
+
+    def __init__(self, path):
+        self.path = path
+        self._content_hash = None
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):  # empty file, pipe...
+                self.map = None
+
+    def read_lines(self, chunk_size=1 << 22, start=0, end=None):
+        '''Yield (byte offset, line) like str.split('\\n') on the content, but
+        only one chunk is held in memory. Without a map, the file is read in
+        buffered chunks and the offsets are None.
+        start, end: only the byte range [start, end) of the map'''
+        if self.map is not None:
+            mm = self.map
+            end = len(mm) if end is None else end
+            chunks = (mm[i:min(i+chunk_size, end)]
+                      for i in range(start, end, chunk_size))
+            yield from self.split_chunks(chunks, start)
+        else:
+            with open(self.path, 'rb') as f:  # closed if the reader stops early too
+                yield from self.split_chunks(iter(lambda: f.read(chunk_size), b''), None)
+
+    def split_chunks(self, chunks, pos):
+        '''See read_lines, pos: the offset of the first chunk or None'''
+        rest = b''
+        for chunk in chunks:
+            chunk = rest + chunk
+            cut = chunk.rfind(b'\n')
+            if cut < 0:
+                rest = chunk
+                continue
+            rest = chunk[cut+1:]
+            text = chunk[:cut].decode()
+            if pos is None or '\r' in text:
+                if '\r' in text:  # universal newlines, as open() in text mode
+                    if text.endswith('\r'):  # of the \r\n at the cut
+                        text = text[:-1]
+                    text = text.replace('\r\n', '\n').replace('\r', '\n')
+                yield from ((None, s) for s in text.split('\n'))
+                if pos is not None:
+                    pos += cut+1
+            else:
+                is_ascii = text.isascii()
+                for s in text.split('\n'):
+                    yield pos, s
+                    pos += (len(s) if is_ascii else len(s.encode()))+1
+        s = rest.decode()
+        if '\r' in s:
+            s = s.replace('\r\n', '\n').replace('\r', '\n')
+            yield from ((None, x) for x in s.split('\n'))
+        else:
+            yield pos, s
+
+    def split_points(self, parts):
+        '''Byte offsets cutting the map into at most parts ranges of about
+        the same size, [0, ..., len(map)]. The ranges begin at the lines of
+        '# -- Begin function', or at the section directive just before.'''
+        mm = self.map
+        points = [0]
+        for i in range(1, parts):
+            pos = mm.find(b'# -- Begin function', max(points[-1], len(mm)*i // parts))
+            if pos < 0:
+                break
+            start = mm.rfind(b'\n', 0, pos) + 1
+            if start > 0:
+                prev = mm.rfind(b'\n', 0, start-1) + 1
+                line_type, word = decode_line(mm[prev:start-1].decode(errors='replace'))[:2]
+                if line_type == 'directive' and word in ('.section', '.data', '.text'):  # no Line: no key id
+                    start = prev
+            if start > points[-1]:
+                points.append(start)
+        points.append(len(mm))
+        return points
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def slice(self, start, end):
+        '''Bytes of [start, end), the missing newline at the end of the file
+        is added'''
+        data = self.map[start:end]
+        if end > len(self.map):
+            data += b'\n'
+        return data
+
+    def content_hash(self):
+        '''blake2b digest of the content, computed once'''
+        if self._content_hash is None:
+            self._content_hash = hashlib.blake2b(self.map, digest_size=32).digest()
+        return self._content_hash
+
+    def is_unchanged(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return self.map is not None and (stat.st_size, stat.st_mtime_ns) == (
+            self.stat.st_size, self.stat.st_mtime_ns)
+
+    def is_same_file(self, path):
+        try:
+            return os.path.samefile(self.path, path)
+        except OSError:
+            return False
+
+
+def read_lines(path, chunk_size=1 << 22):
+    '''Yield the lines of a file like str.split('\\n') on its content, but only
+    one chunk is held in memory.'''
+    source = SourceFile(path)
+    try:
+        for _, s in source.read_lines(chunk_size):
+            yield s
+    finally:  # the map is not kept, also when the reader stops early
+        source.close()
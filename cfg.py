@@ -1,5 +1,22 @@
 import os
+import sys
+import re
+import time
 import logging
+import contextlib
+import functools
+import itertools
+import glob
+import hashlib
+import subprocess
+import array
+import mmap
+import struct
+import zlib
+import bisect
+import collections.abc
+
+from asmplayground import pack_loc
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -7,6 +24,304 @@ logger = logging.getLogger('SCFI')
 logger.setLevel(logging.INFO)
 
 
+# numbered class/struct types, e.g. %class.ns::A.12 and %struct.sv.3.45
+CLASS_NUMBER = re.compile(r"((class\.[^:]+::[^\.]+)\.[\d.]+)")
+STRUCT_NUMBER = re.compile(r"((struct\.[\w]+)\.[\d.]+)")
+# the section headers in the output of the llvm pass, None: not read
+LLVM_PASS_SECTIONS = (('Virtual Function Branches:', 0), ('Virtual Function Targets:', 1),
+                      ('Function Pointer Branches:', 2), ('Function Pointer Targets:', 3),
+                      ('Function Pointer CFG:', None))
+
+
+@functools.lru_cache(maxsize=None)
+def class_strip(s):
+    '''Strip the numbers of class/struct types, the types are few but
+    repeated a lot, so the results are memorized'''
+    for pattern in (CLASS_NUMBER, STRUCT_NUMBER):
+        for numbered, bare in pattern.findall(s):
+            s = s.replace(numbered, bare)
+    return s
+
+
+def read_union_file(path):
+    '''Read the manual type merges, one type per line, a line with only
+    '(end)' ends a merge. Return a dict type -> merged type. The merges are
+    applied in the file order, a type merged by a merge can be merged again
+    by a later one.'''
+    union_set = []
+    if os.path.exists(path):
+        with open(path) as f:
+            union_l = []
+            for line in f:
+                if not line.startswith('(end)'):
+                    union_l.append(line.strip())
+                else:
+                    union_set.append(union_l)
+                    union_l = []
+    union_index = dict()
+    for _type in {t for union_l in union_set for t in union_l}:
+        new_type = _type
+        for union_l in union_set:
+            if new_type in union_l:
+                new_type = union_l[0]
+        union_index[_type] = new_type
+    return union_index
+
+
+def cfg_cache_path(path, union_path, only_virtual):
+    '''The cache of a CFG file: path.<config>.<key>.cfgcache, config is a
+    hash of the union file name and only_virtual (one cache is kept for
+    each), the key is a hash of the file, the union file and the config (and
+    CFG_VERSION)'''
+    config = hashlib.blake2b(b'%d %s' % (bool(only_virtual), os.fsencode(union_path)),
+                             digest_size=4).hexdigest()
+    h = hashlib.blake2b(digest_size=16)
+    h.update(b'%d %d\n' % (CFG_VERSION, bool(only_virtual)))
+    if os.path.exists(union_path):
+        with open(union_path, 'rb') as f:
+            h.update(f.read())
+    else:
+        h.update(b'\0')  # not the same as an empty union file
+    h.update(b'\0')
+    with open(path, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, 1 << 20), b''):
+            h.update(chunk)
+    return '%s.%s.%s.cfgcache' % (path, config, h.hexdigest())
+
+
+def remove_stale_cfg_caches(path, cache_path):
+    '''Remove the caches of path older than cache_path: of the same config
+    with another key, or of any config written before path was modified.
+    Other processes may remove them too.'''
+    config = cache_path[len(path):].split('.')[1]
+    mtime = os.stat(path).st_mtime
+    for old_path in glob.glob(glob.escape(path) + '.*.cfgcache'):
+        if old_path == cache_path:
+            continue
+        try:
+            if (old_path[len(path):].split('.')[1] == config
+                    or os.stat(old_path).st_mtime < mtime):
+                os.remove(old_path)
+        except FileNotFoundError:
+            pass
+
+
+def read_llvm_pass_sets(f, union_index=None):
+    '''Stream the lines of the llvm pass output. Return the dicts type ->
+    set of items of: virtual branches, virtual targets, pointer branches,
+    pointer targets, and the number of lines read. A type without items
+    (e.g. only the :0:0 locations of branches without a line) is not added.
+    >>> read_llvm_pass_sets(['Virtual Function Branches:', 'Type: void (%class.A*)', 'a.cc:0:0',
+    ...                      'Function Pointer Targets:', 'Type: void (%class.A*)', 'func7'])
+    ({}, {}, {}, {'void (%class.A*)': {'func7'}}, 6)
+    '''
+    union_index = union_index or dict()
+    sets = (dict(), dict(), dict(), dict())
+    current_set = None  # empty
+    current_items = None  # the set of the current type in current_set
+    _type = ''
+    count = 0
+    for line in f:
+        count += 1
+        if line.startswith('#'):
+            continue  # white list
+        item = line.strip()
+        if item.endswith('0:0'):
+            continue
+        if line[0] in 'VF':
+            for header, index in LLVM_PASS_SECTIONS:
+                if line.startswith(header):
+                    current_set = sets[index] if index is not None else None
+                    current_items = None
+                    break
+            else:
+                header = None
+            if header is not None:
+                continue
+        if current_set is None:
+            continue
+        if line.startswith('Type:'):
+            _type = class_strip(item[6:])
+            _type = union_index.get(_type, _type)
+            current_items = None  # a type is added with its first item only
+            continue
+        if current_items is None:  # the first item since the type line or the header
+            current_items = current_set.setdefault(_type, set())
+        current_items.add(item)
+    return sets + (count,)
+
+
+# binary CFG (CFG.dump/CFG.load): arrays of ints after a header, each with
+# a (typecode, length) header and padded to 8 bytes. The strings are stored
+# once in a table, tags are numbered, the tags of the branches/targets are
+# in CSR form (the tags of the i-th key are indices[indptr[i]:indptr[i+1]],
+# indptr is left empty when each key has one tag, as the branches do).
+# The keys of a map are a run of the string table, in the order of their
+# hashes, and the sorted hashes are stored (4 bytes a key): a key is found by
+# binary search on them. The file is used through mmap as it is: processes
+# loading the same file share its pages.
+CFG_MAGIC = b'SCFICFG\0'
+CFG_VERSION = 4  # bump when the format or the reading changes, older caches are ignored
+CFG_HEADER = struct.Struct('=8sIQ')  # magic, version, number of blocks
+CFG_BLOCK = struct.Struct('=cQ')     # array typecode, length
+CFG_BLOCKS = 12
+
+
+def string_hash(b):
+    '''A hash stable between processes (str hash is not), of utf-8 bytes'''
+    return zlib.crc32(b)
+
+
+class StringTable():
+    '''The strings of a binary CFG: utf-8 bytes, string i is
+    data[offsets[i]:offsets[i+1]]'''
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_bytes(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]]
+
+    def __getitem__(self, i):
+        return str(self.get_bytes(i), 'utf-8')
+
+
+class CSRMap(collections.abc.Mapping):
+    '''A read only map key -> set of tags, over the arrays of a binary CFG.
+    Key i is the string first+i, the keys are in the order of their hashes.'''
+
+    def __init__(self, strings, tags, first, hashes, indptr, indices):
+        self.strings = strings  # StringTable
+        self.tags = tags        # tag id -> tag (str)
+        self.first = first      # string id of the first key
+        self.hashes = hashes    # string_hash of key i, sorted
+        self.indptr = indptr if len(indptr) else range(len(hashes)+1)
+        self.indices = indices  # tag ids
+
+    def find(self, key):
+        '''Index of the key, or -1'''
+        b = key.encode()
+        h = string_hash(b)
+        hashes, get_bytes = self.hashes, self.strings.get_bytes
+        i = bisect.bisect_left(hashes, h)
+        while i < len(hashes) and hashes[i] == h:
+            if get_bytes(self.first+i) == b:
+                return i
+            i += 1
+        return -1
+
+    def tag_ids(self, key):
+        '''The tag ids of the key, without building the tags'''
+        i = self.find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+    def __getitem__(self, key):
+        return set(map(self.tags.__getitem__, self.tag_ids(key)))
+
+    def __contains__(self, key):
+        return isinstance(key, str) and self.find(key) >= 0
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __iter__(self):
+        strings = self.strings
+        for sid in range(self.first, self.first + len(self)):
+            yield strings[sid]
+
+    def tag_id_items(self):
+        '''(key, tag ids) of each key'''
+        indptr, indices = self.indptr, self.indices
+        for i, key in enumerate(self):
+            yield key, indices[indptr[i]:indptr[i+1]]
+
+    def items(self):
+        tags = self.tags
+        for key, ids in self.tag_id_items():
+            yield key, set(map(tags.__getitem__, ids))
+
+
+def uint_array(values):
+    '''An array of the smallest unsigned type holding the values'''
+    values = list(values)
+    top = max(values, default=0)
+    for typecode in ('B', 'H', 'I', 'Q'):
+        if top < 1 << 8*array.array(typecode).itemsize:
+            return array.array(typecode, values)
+
+
+def hash_order(keys):
+    '''The keys in the order of CSRMap, and their hashes'''
+    hashed = sorted((string_hash(key.encode()), key) for key in keys)
+    return [key for h, key in hashed], array.array('I', [h for h, key in hashed])
+
+
+def csr_blocks(keys, mapping, tag_id):
+    '''The indptr and indices arrays of a map key -> tags, in the order of
+    keys'''
+    indptr, indices = [0], []
+    for key in keys:
+        indices.extend(map(tag_id, mapping[key]))
+        indptr.append(len(indices))
+    if indptr == list(range(len(keys)+1)):
+        indptr = []  # one tag each
+    return [uint_array(indptr), uint_array(indices)]
+
+
+class DisjointSet():
+    '''Union-find with path compression and union by rank. Elements are
+    added by union, an unknown element is its own class.'''
+
+    def __init__(self):
+        self.parent = dict()
+        self.rank = dict()
+
+    def find(self, x):
+        parent = self.parent
+        root = x
+        while root in parent:
+            root = parent[root]
+        while x != root:  # path compression
+            parent[x], x = root, parent[x]
+        return root
+
+    def union(self, x, y):
+        '''Merge the classes of x and y, return the root'''
+        x, y = self.find(x), self.find(y)
+        if x == y:
+            return x
+        rank_x, rank_y = self.rank.get(x, 0), self.rank.get(y, 0)
+        if rank_x < rank_y:
+            x, y = y, x
+        elif rank_x == rank_y:
+            self.rank[x] = rank_x + 1
+        self.parent[y] = x
+        return x
+
+    def classes(self):
+        '''root -> sorted members (the root too), for the classes with more
+        than one element
+        >>> s = DisjointSet()
+        >>> s.union('a', 'b'), s.union('a', 'c'), s.union('x', 'y')
+        ('a', 'a', 'x')
+        >>> s.classes()
+        {'a': ['a', 'b', 'c'], 'x': ['x', 'y']}
+        '''
+        members = dict()
+        for x in self.parent:
+            root = self.find(x)
+            members.setdefault(root, [root]).append(x)
+        for lst in members.values():
+            lst.sort()
+        return members
+
+
 class CFG():
     '''Label based CFG, each target/branch has tags(labels)
     Tags can be strings, int ...
@@ -18,197 +333,312 @@ class CFG():
         self.target = target  # label-> [tags]
         self.branch = branch  # debug loc -> [tags]
         # remember: the tags is in a list, we support multi tags
+        self.merged_types = dict()  # Merged_type_N -> the types merged into it
+        self.tag_names = None   # tag number -> tag, see number_tags
+        self.tag_number = None  # tag -> tag number
 
     @classmethod
-    def read_from_llvm_pass(cls, path, union_file='scfi_tmp.union',  only_virtual=False):
+    def read_from_llvm_pass(cls, path, union_file='scfi_tmp.union',  only_virtual=False, cache=True):
         '''
         Read from our CFG from the llvm pass:
-        
+
+        path: the output file of the pass, '-' for stdin, or an opened file
+        (e.g. a pipe from opt, see read_from_opt), it is read as a stream
         union_file: Manually merge some types, the format is one type per line, and a line with only '(end)' ends a merge.
+        It is looked up in the directory of path (the current directory for streams).
         only_virtual: only remain the virtual function results
+        cache: for a file, keep the result next to it (see cfg_cache_path),
+        and load it instead of reading again while the inputs are the same
 
         '''
-        import re
         logger.info('Read CFG from llvm pass: only_virtual:%s ' % str(only_virtual))
-  
-
-        # strip class/struct number,
-        def class_strip(s):
-            pattern = re.compile(r"class\.[^:]+::[^\.]+\.[\d.]+")
-            lst = re.findall(pattern, s)
-            for _type in lst:
-                pattern = re.compile(r"class\.[^:]+::[^\.]+")
-                new_type = re.match(pattern, _type).group()
-                s = s.replace(_type, new_type)
-
-            pattern = re.compile(r"struct\.[\w]+\.[\d.]+")
-            lst = re.findall(pattern, s)
-            for _type in lst:
-                pattern = re.compile(r"struct\.[\w]+")
-                new_type = re.match(pattern, _type).group()
-                s = s.replace(_type, new_type)
-            return s
-
-        # sometimes we need union some set
-        union_set = []
-        if os.path.exists(os.path.join(os.path.split(path)[0], union_file)):
-            with open(os.path.join(os.path.split(path)[0], union_file)) as f:
-                union_l = []
-                for line in f:
-                    if not line.startswith('(end)'):
-                        union_l.append(line.strip())
-                    else:
-                        union_set.append(union_l)
-                        union_l = []
-
-        # read the file
-        with open(path) as f:
-            target, branch = dict(), dict()
-            # first read the cfg in type
-            virtual_branch = dict()
-            virtual_target = dict()
-            pointer_branch = dict()
-            pointer_target = dict()
-
-            _type = ""
-            items = set()
-            current_set = None  # empty
-            for line in f:
-                if line.startswith('#'):
-                    continue  # white list
-                if line.strip().endswith('0:0'):
-                    continue
-                if line.startswith('Virtual Function Branches:'):
-                    current_set = virtual_branch
-                    continue
-                if line.startswith('Virtual Function Targets:'):
-                    current_set = virtual_target
-                    continue
-                if line.startswith('Function Pointer Branches:'):
-                    current_set = pointer_branch
-                    continue
-                if line.startswith('Function Pointer Targets:'):
-                    current_set = pointer_target
-                    continue
-                if line.startswith('Function Pointer CFG:'):
-                    current_set = None
-                    continue
-
-                if current_set == None:
-                    continue
-                if line.startswith('Type:'):
-                    _type = class_strip(line.strip()[6:])
-                    for union_lst in union_set:
-                        if _type in union_lst:
-                            _type = union_lst[0]
-                    # print(_type)
-                    continue
+        if isinstance(path, str) and path != '-':
+            union_path = os.path.join(os.path.split(path)[0], union_file)
+        else:
+            union_path = union_file
+            cache = False
+
+        if cache:
+            cache_path = cfg_cache_path(path, union_path, only_virtual)
+            if os.path.exists(cache_path):
+                try:
+                    cfg = cls.load(cache_path)
+                    logger.info('Load CFG from the cache %s' % cache_path)
+                    return cfg
+                except Exception as e:
+                    logger.warning('Broken CFG cache %s: %s' % (cache_path, e))
+
+        cfg = cls.parse_llvm_pass(path, read_union_file(union_path), only_virtual)
+        if cache:
+            try:
+                cfg.dump(cache_path)
+            except OSError as e:
+                logger.warning('Cannot write the CFG cache %s: %s' % (cache_path, e))
+                return cfg
+            try:
+                remove_stale_cfg_caches(path, cache_path)
+            except OSError as e:
+                logger.warning('Cannot remove the old CFG caches of %s: %s' % (path, e))
+            # the same as a later load from the cache
+            return cls.load(cache_path)
+        return cfg
+
+    @classmethod
+    def parse_llvm_pass(cls, path, union_index, only_virtual=False):
+        '''See read_from_llvm_pass, union_index: see read_union_file'''
+        if path == '-':
+            f = contextlib.nullcontext(sys.stdin)
+        elif isinstance(path, str):
+            f = open(path)
+        else:
+            f = contextlib.nullcontext(path)
+        with f as f:
+            start = time.time()
+            virtual_branch, virtual_target, pointer_branch, pointer_target, count = \
+                read_llvm_pass_sets(f, union_index)
+            elapsed = time.time() - start
+            logger.info('Read %d lines in %.2fs (%d lines/sec)' %
+                        (count, elapsed, count / elapsed if elapsed else 0))
+
+        if only_virtual:
+            pointer_target = pointer_branch = dict()
+
+        # remove items in Function Pointer if in Virtual Call
+        rm_lst = []
+        for key in pointer_branch.keys():
+            if key in virtual_branch.keys():
+                rm_lst.append(key)
+        for key in rm_lst:
+            del pointer_branch[key]
+        rm_lst = []
+        for key in pointer_target.keys():
+            if key in virtual_target.keys():
+                rm_lst.append(key)
+        for key in rm_lst:
+            del pointer_target[key]
+
+        tmp_branch = dict()
+        for key in virtual_branch.keys():
+            for item in virtual_branch[key]:
                 try:
-                    current_set[_type].add(line.strip())
+                    tmp_branch[item].add(key)
                 except KeyError:
-                    current_set[_type] = set([line.strip()])
-
-            if only_virtual:
-                pointer_target = pointer_branch = dict()
-
-            # remove items in Function Pointer if in Virtual Call
-            rm_lst = []
-            for key in pointer_branch.keys():
-                if key in virtual_branch.keys():
-                    rm_lst.append(key)
-            for key in rm_lst:
-                del pointer_branch[key]
-            rm_lst = []
-            for key in pointer_target.keys():
-                if key in virtual_target.keys():
-                    rm_lst.append(key)
-            for key in rm_lst:
-                del pointer_target[key]
-
-            tmp_branch = dict()
-            for key in virtual_branch.keys():
-                for item in virtual_branch[key]:
+                    tmp_branch[item] = set([key])
+        for key in pointer_branch.keys():
+            for item in pointer_branch[key]:
+                try:
+                    tmp_branch[item].add(key)
+                except KeyError:
+                    tmp_branch[item] = set([key])
+
+        # merge multi type of branchs
+        # in fact, it may lose some security
+        # TODO: for better security, DIVIDE not MERGE the class
+        # each multi type branch merges the classes of its types into a new
+        # class Merged_type_N, a class merged again is renamed
+        merged = DisjointSet()
+        merged_names = dict()  # root type -> the name of its class
+        merge_type_count = 0
+        for types in tmp_branch.values():
+            if len(types) == 1:
+                continue
+            types = iter(types)
+            root = merged.find(next(types))
+            for _type in types:
+                root = merged.union(root, _type)
+            merged_names[root] = 'Merged_type_%d' % merge_type_count
+            merge_type_count += 1
+
+        def merged_type(_type):
+            return merged_names.get(merged.find(_type), _type)
+
+        target, branch = dict(), dict()
+        for br_set in [virtual_branch, pointer_branch]:
+            for key in br_set.keys():
+                new_type = merged_type(key)
+                for item in br_set[key]:
                     try:
-                        tmp_branch[item].add(key)
+                        branch[item].add(new_type)
+                        if len(branch[item]) > 1:
+                            logger.warn(
+                                'Multi-tag branch found: %s' % item)
                     except KeyError:
-                        tmp_branch[item] = set([key])
-            for key in pointer_branch.keys():
-                for item in pointer_branch[key]:
+                        branch[item] = set([new_type])
+
+        for tg_set in [virtual_target, pointer_target]:
+            for key in tg_set.keys():
+                new_type = merged_type(key)
+                for item in tg_set[key]:
                     try:
-                        tmp_branch[item].add(key)
+                        target[item].add(new_type)
+                        if len(target[item]) > 1:
+                            logger.debug(
+                                'Multi-tag target found: %d %s' % (len(target[item]), item))
                     except KeyError:
-                        tmp_branch[item] = set([key])
-
-            # merge multi type of branchs
-            # in fact, it may lose some security
-            # TODO: for better security, DIVIDE not MERGE the class
-            merge_type = dict()  # from type to a merge number
-            merge_type_count = 0
-            for item in tmp_branch.keys():
-                if len(tmp_branch[item]) == 1:
-                    continue
-                new_type_lst = []
-                for _type in tmp_branch[item]:
-                    # map to new type recursely
-                    new_type = _type
-                    while new_type in merge_type.keys():
-                        new_type = merge_type[new_type]
-                    new_type_lst.append(new_type)
-                new_merge_type = 'Merged_type_%d' % merge_type_count
-                merge_type_count += 1
-                for new_type in new_type_lst:
-                    merge_type[new_type] = new_merge_type
-                tmp_branch[item] = set([new_merge_type])
-
-            target, branch = dict(), dict()
-            for br_set in [virtual_branch, pointer_branch]:
-                for key in br_set.keys():
-                    new_type = key
-                    while new_type in merge_type.keys():
-                        new_type = merge_type[new_type]
-                    for item in br_set[key]:
-                        try:
-                            branch[item].add(new_type)
-                            if len(branch[item]) > 1:
-                                logger.warn(
-                                    'Multi-tag branch found: %s' % item)
-                        except KeyError:
-                            branch[item] = set([new_type])
-
-            for tg_set in [virtual_target, pointer_target]:
-                for key in tg_set.keys():
-                    new_type = key
-                    while new_type in merge_type.keys():
-                        new_type = merge_type[new_type]
-                    for item in tg_set[key]:
-                        try:
-                            target[item].add(new_type)
-                            if len(target[item]) > 1:
-                                logger.debug(
-                                    'Multi-tag target found: %d %s' % (len(target[item]), item))
-                        except KeyError:
-                            target[item] = set([new_type])
-
-        return cls(target, branch)
-
-    def convert_filename_to_number(self, file_numbers):
-        '''convert the string:y:z to x y z form'''
-        for branch_loc in [k for k in self.branch.keys()]:
+                        target[item] = set([new_type])
+
+        cfg = cls(target, branch)
+        cfg.merged_types = {merged_names[root]: members
+                            for root, members in merged.classes().items()}
+        return cfg
+
+    @classmethod
+    def read_from_opt(cls, args, **kwargs):
+        '''Run the llvm pass and read its output (stderr) from the pipe, e.g.
+        args = ['opt', '-load', 'LLVMSCFI.so', 'a.bc', '-indirect-calls']
+        kwargs: see read_from_llvm_pass'''
+        proc = subprocess.Popen(args, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, universal_newlines=True)
+        with proc:
+            cfg = cls.read_from_llvm_pass(proc.stderr, **kwargs)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, args)
+        return cfg
+
+    def number_tags(self):
+        '''Number the tags densely from 0: self.tag_names (number -> tag) and
+        self.tag_number (tag -> number). A loaded CFG keeps the numbers of the
+        file. Return tag_names.'''
+        if getattr(self, 'tag_names', None) is None:  # not in old pickles
+            if isinstance(self.target, CSRMap) and isinstance(self.branch, CSRMap) and \
+                    self.target.tags is self.branch.tags:
+                self.tag_names = self.target.tags
+            else:
+                names = set()
+                for tags in itertools.chain(self.branch.values(), self.target.values()):
+                    names.update(tags)
+                self.tag_names = sorted(names, key=str)
+            self.tag_number = {tag: i for i, tag in enumerate(self.tag_names)}
+        return self.tag_names
+
+    def tag_id_items(self, mapping):
+        '''(key, tag numbers) of each key of self.branch or self.target'''
+        if isinstance(mapping, CSRMap):
+            return mapping.tag_id_items()
+        self.number_tags()
+        number = self.tag_number
+        return ((key, [number[tag] for tag in tags]) for key, tags in mapping.items())
+
+    def target_tag_ids(self, label):
+        '''The tag numbers of the target label, KeyError if it has none'''
+        if isinstance(self.target, CSRMap):
+            return self.target.tag_ids(label)
+        self.number_tags()
+        return [self.tag_number[tag] for tag in self.target[label]]
+
+    def branch_loc_index(self, file_numbers):
+        '''Normalize the branch locations "file:line:col" once into packed
+        (file number, line, column) ints, the keys of Line.loc.
+        Return the index loc -> (location string, tag numbers), and the
+        locations whose file is not in file_numbers'''
+        index = dict()
+        unknown = []
+        for branch_loc, tags in self.tag_id_items(self.branch):
+            fields = branch_loc.split(':')
             try:
-                new_key = str(file_numbers[branch_loc.split(':')[0]])
-                new_key += ' '+' '.join(branch_loc.split(':')[1:3])
-                self.branch[new_key] = self.branch[branch_loc]
-                self.branch.pop(branch_loc)
-            except KeyError:  # some branches in CFG do not appera in assemble file
+                loc = pack_loc(file_numbers[fields[0]], *map(int, fields[1:3]))
+            except (KeyError, ValueError, TypeError):  # some branches in CFG do not appear in assemble file
+                unknown.append(branch_loc)
                 continue
+            index[loc] = (branch_loc, tags)
+        return index, unknown
 
     def dump(self, path):
-        import pickle
-        with open(path, 'wb+') as f:
-            pickle.dump(self, f)
+        '''Write the binary form, see CFG_MAGIC. A CFG with keys or tags other
+        than str is pickled.'''
+        def is_str_map(mapping):
+            return all(isinstance(key, str) and all(isinstance(tag, str) for tag in tags)
+                       for key, tags in mapping.items())
+        if not (is_str_map(self.branch) and is_str_map(self.target) and is_str_map(self.merged_types)):
+            logger.info('CFG with other than str keys or tags, pickled: %s' % path)
+            blocks = None
+        else:
+            blocks = self.binary_blocks()
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                if blocks is None:
+                    import pickle
+                    pickle.dump(self, f)
+                else:
+                    f.write(CFG_HEADER.pack(CFG_MAGIC, CFG_VERSION, len(blocks)))
+                    for block in blocks:
+                        f.write(CFG_BLOCK.pack(block.typecode.encode(), len(block)))
+                        block.tofile(f)
+                        f.write(b'\0' * (-f.tell() % 8))
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def binary_blocks(self):
+        '''The arrays of the binary form'''
+        branch_keys, branch_hashes = hash_order(self.branch)
+        target_keys, target_hashes = hash_order(self.target)
+        strings = dict()  # string -> id, of the strings other than the keys
+        tags = dict()     # tag -> id
+        first = len(branch_keys) + len(target_keys)
+
+        def sid(s):
+            try:
+                return strings[s]
+            except KeyError:
+                strings[s] = first + len(strings)
+                return strings[s]
+
+        def tag_id(tag):
+            try:
+                return tags[tag]
+            except KeyError:
+                tags[tag] = len(tags)
+                return tags[tag]
+
+        for tags_of in itertools.chain(self.branch.values(), self.target.values()):
+            for tag in tags_of:  # numbered in the order of the maps, not of the keys
+                tag_id(tag)
+        merged = {name: [sid(member) for member in members]
+                  for name, members in self.merged_types.items()}
+        blocks = ([branch_hashes] + csr_blocks(branch_keys, self.branch, tag_id) +
+                  [target_hashes] + csr_blocks(target_keys, self.target, tag_id) +
+                  [uint_array(map(tag_id, merged)),
+                   uint_array(itertools.accumulate(map(len, merged.values()), initial=0)),
+                   uint_array(itertools.chain.from_iterable(merged.values()))])
+        blocks.insert(0, uint_array(map(sid, tags)))
+        data = [s.encode() for s in itertools.chain(branch_keys, target_keys, strings)]
+        blocks[:0] = [array.array('B', b''.join(data)),
+                      uint_array(itertools.accumulate(map(len, data), initial=0))]
+        return blocks
 
     @classmethod
     def load(cls, path):
-        import pickle
+        '''Load a CFG written by dump, the maps are views of the mapped file.
+        Older pickled dumps are still read.'''
         with open(path, 'rb') as f:
-            return pickle.load(f)
+            if f.read(len(CFG_MAGIC)) != CFG_MAGIC:
+                import pickle
+                f.seek(0)
+                return pickle.load(f)
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n = CFG_HEADER.unpack_from(mm)
+        if version != CFG_VERSION or n != CFG_BLOCKS:
+            raise ValueError('%s: CFG format version %d is not supported' % (path, version))
+        view = memoryview(mm)
+        blocks = []
+        offset = CFG_HEADER.size
+        for _ in range(n):
+            typecode, length = CFG_BLOCK.unpack_from(mm, offset)
+            typecode = typecode.decode()
+            offset += CFG_BLOCK.size
+            size = length*array.array(typecode).itemsize
+            blocks.append(view[offset:offset+size].cast(typecode))
+            offset += size + (-(offset+size) % 8)
+        strings = StringTable(blocks[0], blocks[1])
+        tags = [sys.intern(strings[i]) for i in blocks[2]]
+        branch = CSRMap(strings, tags, 0, *blocks[3:6])
+        target = CSRMap(strings, tags, len(branch), *blocks[6:9])
+        cfg = cls(target, branch)
+        cfg.number_tags()
+        merged_names, merged_indptr, merged_members = blocks[9:12]
+        cfg.merged_types = {tags[t]: [strings[i] for i in merged_members[merged_indptr[k]:merged_indptr[k+1]]]
+                            for k, t in enumerate(merged_names)}
+        return cfg
@@ -1,6 +1,8 @@
 '''A tool that can generate quasi-linear Huffman trees.
 
 Read http://readm.tech/2020/02/03/huffman/'''
+import heapq
+
 
 class Node():
     def __init__(self, symbol=None, weight=None, left=None, right=None, parent=None):
@@ -12,10 +14,12 @@ class Node():
 
     @property
     def code(self):
-        if self.parent == None:
-            return ''
-        else:
-            return self.parent.code + ('0' if self is self.parent.left else '1')
+        code = []
+        node = self
+        while node.parent is not None:
+            code.append('0' if node is node.parent.left else '1')
+            node = node.parent
+        return ''.join(reversed(code))
 
 
 def codebook(iter, weight_fun=lambda x, y: x+y):
@@ -25,23 +29,138 @@ def codebook(iter, weight_fun=lambda x, y: x+y):
     Examples:
     >>> codebook([('A', 2), ('B', 4), ('C', 1), ('D', 1)])
     {'A': '10', 'B': '0', 'C': '110', 'D': '111'}
+
+    Each step merges the two lightest nodes, the first one taken is the
+    right child. Ties: among the nodes of the same weight, the one created
+    last is taken first (the input symbols are created in order, before
+    the merged nodes). weight_fun: the weight of the merged node.
     """
-    available = []
+    symbols = []
+    heap = []
     for i in iter:
-        available.append(Node(symbol=i[0], weight=i[1]))
-
-    copy = [n for n in available]
+        # key (weight, -sequence number): the latest of the lightest first
+        heap.append((i[1], -len(symbols), len(symbols)))
+        symbols.append(i[0])
 
-    if len(available) == 0:
+    if len(symbols) == 0:
         return dict([])
 
-    while len(available) > 1:
-        available.sort(key=lambda x: x.weight, reverse=True)
-        r = available.pop()
-        l = available.pop()
-        p = Node(left=l, right=r, weight=weight_fun(l.weight, r.weight))
-        l.parent = p
-        r.parent = p
-        available.append(p)
+    # nodes are numbered: the symbols first, then the merged nodes
+    left, right = [], []
+    n = len(symbols)
+    heapq.heapify(heap)
+    while len(heap) > 1:
+        r_weight, _, r = heapq.heappop(heap)
+        l_weight, _, l = heapq.heappop(heap)
+        p = n + len(left)
+        left.append(l)
+        right.append(r)
+        heapq.heappush(heap, (weight_fun(l_weight, r_weight), -p, p))
 
-    return {n.symbol: n.code for n in copy}
+    # codes from the root down, without recursion
+    code = [None] * (n + len(left))
+    root = heap[0][2]
+    code[root] = ''
+    stack = [root]
+    while stack:
+        p = stack.pop()
+        if p >= n:
+            prefix = code[p]
+            l, r = left[p-n], right[p-n]
+            code[l] = prefix + '0'
+            code[r] = prefix + '1'
+            stack.append(l)
+            stack.append(r)
+    return {symbols[i]: code[i] for i in range(n)}
+
+
+def package_merge(costs, max_length, fallback=None):
+    """
+    Length-limited optimal code lengths by package-merge.
+    costs[i](l): the cost of a code of length l for the symbol i, it must be
+    convex in l (e.g. weight*l, or weight*2**l).
+    fallback[i]: the cost of leaving the symbol out of the code (None: the
+    symbol must be coded), it must be more than costs[i](max_length) plus
+    the last increase, costs[i](max_length) - costs[i](max_length-1).
+    Return the lengths, None for the symbols left out. The sum of the costs
+    is minimal among the prefix codes of lengths 1 to max_length: a symbol
+    coded alone has 1 bit too (the other code of the bit is unused).
+    >>> package_merge([lambda l: 100*2**l], 2)
+    [1]
+    >>> package_merge([lambda l: 1*2**l, lambda l: 100*2**l], 2, [16, None])
+    [1, 1]
+    >>> package_merge([lambda l: 4*2**l, lambda l: 15*2**l], 1, [50, 50])
+    [1, 1]
+    """
+    if not costs:
+        return []
+    fallback = list(fallback or [None] * len(costs))
+    # a symbol of length 0 (coded alone, with no bit) takes no coin: the
+    # first coin of each symbol costs big less, so it is always taken. A
+    # free symbol, left out for free, fills the other half of the code space
+    # when only one symbol is coded.
+    big = 1 + sum(abs(c(max_length)) for c in costs) + sum(abs(f) for f in fallback if f is not None)
+    real = len(costs)
+    costs = list(costs) + [lambda l: 0]
+    fallback.append(0)
+    n = len(costs)
+    # coins: the l-th coin of a symbol, of width 2**-l, costs the increase of
+    # its cost from length l-1 to l, so a symbol of length l takes l coins.
+    # Leaving a symbol out takes one more coin of width 2**-max_length, the
+    # coins of a symbol have the width 1 then: no code space is used.
+    # The coins of the total width n-1 (the Kraft sum of the code is 1) of
+    # the least cost are taken, the increases are monotone so the coins of a
+    # symbol are taken from length 1 on.
+    # item: (cost, tie, symbol): symbol i for a coin, n+i for leaving the
+    # symbol out, -1 for a package of two items of the deeper level
+    marginal = [[c(l) - c(l-1) if l > 1 else c(1) for l in range(max_length+1)]
+                for c in costs]
+    for i in range(real):
+        marginal[i][1] -= big
+    levels = []
+    packages = []
+    for l in range(max_length, 0, -1):
+        items = [(marginal[i][l], i, i) for i in range(n)]
+        if l == max_length:
+            items.extend((fallback[i] - costs[i](max_length), n+i, n+i)
+                         for i in range(n) if fallback[i] is not None)
+        items.extend(packages)
+        items.sort()
+        del items[2*(n-1):]  # the rest can not be taken
+        levels.append(items)
+        packages = [(items[k][0] + items[k+1][0], 2*n+k, -1)
+                    for k in range(0, len(items)-1, 2)]
+    if len(levels[-1]) < 2*(n-1):
+        raise ValueError('%d symbols do not fit in codes of %d bits' % (n, max_length))
+    lengths = [0] * n
+    left_out = [False] * n
+    need = 2*(n-1)
+    for items in reversed(levels):  # from the level 1
+        taken = 0
+        for cost, tie, symbol in items[:need]:
+            if symbol < 0:
+                taken += 1
+            elif symbol < n:
+                lengths[symbol] += 1
+            else:
+                left_out[symbol-n] = True
+        need = 2*taken
+    return [None if out else length for length, out in zip(lengths[:real], left_out)]
+
+
+def canonical_codebook(lengths):
+    """
+    Canonical prefix codes of the given lengths ({symbol: length}), the
+    shorter codes first, symbols of the same length in the given order.
+    >>> canonical_codebook({'A': 2, 'B': 1, 'C': 3, 'D': 3})
+    {'B': '0', 'A': '10', 'C': '110', 'D': '111'}
+    """
+    code = dict()
+    value = 0
+    last = 0
+    for symbol, length in sorted(lengths.items(), key=lambda x: x[1]):
+        value <<= length - last
+        last = length
+        code[symbol] = format(value, '0%db' % length) if length else ''
+        value += 1
+    return code
@@ -1,6 +1,11 @@
 from pprint import pprint
 import logging
 import subprocess
+import contextlib
+import copy
+import array
+import heapq
+import time
 
 
 from asmplayground import *
@@ -20,6 +25,38 @@ DETERMIN = 3
 # attributes set:
 # 'reserved_tags': we add the instruction with tags, but did not decide its slot
 # 'tags', 'slots'
+LINE_STATE = ('tags', 'slots', 'slots_info', 'slot_info', 'reserved_tags')
+# AsmSrc attributes not changed by the instrumentation or kept by the journal,
+# SCFIAsm.fork does not copy them. key_id is not restored: the key ids are
+# never reused.
+SHARED_STATE = ('lines', 'HEAD', 'label_name_to_line', 'label_list', 'section_lines',
+                'sections', 'declarations', 'functions', 'function_extents',
+                'function_begins', 'line_hash_index', 'debug_file_number', 'file_number_trie',
+                'journal', 'source', 'parsed_keys', 'key_id')
+
+
+X86_CALLS = frozenset(('call', 'callq', 'calll', 'callw'))
+X86_JUMPS = frozenset(('jmp', 'jmpq', 'jmpl', 'jmpw'))
+X86_RETURNS = frozenset(('ret', 'retq', 'retl', 'retw', 'lret', 'lretq', 'lretl', 'iret', 'iretq', 'iretl'))
+X86_PREFIXES = frozenset(('notrack', 'bnd', 'rep', 'repe', 'repz', 'repne', 'repnz', 'lock', 'data16'))
+# registers free to change before an indirect call: caller saved and not
+# used to pass arguments (%rax holds the number of vector args of varargs)
+X86_SCRATCH_REGS = frozenset(('r10', 'r11'))
+
+
+def strip_x86_prefixes(opcode, operands):
+    '''The opcode and the operands of an instruction after its prefixes
+    >>> strip_x86_prefixes('notrack', 'call *%rax')
+    ('call', '*%rax')
+    >>> strip_x86_prefixes('bnd', 'jmp *(%rdx,%rax,8)')
+    ('jmp', '*(%rdx,%rax,8)')
+    >>> strip_x86_prefixes('callq', '*%rax')
+    ('callq', '*%rax')
+    '''
+    while opcode in X86_PREFIXES and operands:
+        fields = operands.split(None, 1)
+        opcode, operands = fields[0], fields[1] if len(fields) > 1 else ''
+    return opcode, operands
 
 
 class ToolKit():
@@ -38,26 +75,47 @@ class ToolKit():
         self.tmp_label_count += 1
         return '.scfi_tmp%d%s' % (self.tmp_label_count, info)
 
+    def get_opcode(self, line):
+        '''The opcode of an instruction, after its prefixes'''
+        return strip_x86_prefixes(line.get_opcode(), line.get_operands())[0]
+
     def is_control_transfer(self, line):
         if global_env.isa == X86:
-            op = line.get_opcode()
+            op = self.get_opcode(line)
             if not op:
                 return False
-            if 'ret' in op:
-                return True
-            if op.startswith('j'):
-                return True
-            if 'call' in op:
-                return True
-            return False
+            return op in X86_CALLS or op in X86_RETURNS or op.startswith('j')
         else:
             raise Exception('Not implemented.')
 
+    def is_call(self, line):
+        if global_env.isa == X86:
+            return self.get_opcode(line) in X86_CALLS
+        raise Exception('Unsupported syntax or ISA')
+
+    def get_target_operand(self, line):
+        '''The decoded operand of a call/jump, None if it is not a branch
+        with one operand'''
+        if not line.is_instruction:
+            return None
+        operands = decode_operands(strip_x86_prefixes(line.get_opcode(), line.get_operands())[1])
+        return operands[0] if len(operands) == 1 else None
+
     def is_indirect_call(self, line):
+        '''
+        >>> tk = ToolKit()
+        >>> tk.is_indirect_call(Line('\tnotrack call\t*%rax')), tk.is_indirect_call(Line('\tcallq\tfoo'))
+        (True, False)
+        >>> tk.get_call_expr(Line('\tnotrack callq\t*8(%rbx)  # vtable'))
+        '8(%rbx)'
+        '''
         # remember to add rules for more languages
         if global_env.isa == X86:
             if global_env.syntax == ATT:
-                return True if line.is_instruction and 'call' in line and '*' in line else False
+                if self.get_opcode(line) not in X86_CALLS:
+                    return False
+                operand = self.get_target_operand(line)
+                return operand is not None and operand.indirect
         raise Exception('Unsupported syntax or ISA')
 
     # TODO: support indirect jump
@@ -65,14 +123,28 @@ class ToolKit():
         return False
         if global_env.isa == X86:
             if global_env.syntax == ATT:
-                return True if line.is_instruction and 'jmp' in line and '*' in line else False
+                if self.get_opcode(line) not in X86_JUMPS:
+                    return False
+                operand = self.get_target_operand(line)
+                return operand is not None and operand.indirect
         raise Exception('Unsupported syntax or ISA')
 
     def is_indirect_branch(self, line):
         return self.is_indirect_call(line) or self.is_indirect_jump(line)
 
     def get_call_expr(self, line):
-        return line.strip_comment().split('*')[-1]
+        '''The target expression of an indirect branch, e.g. %rax for call *%rax'''
+        operand = self.get_target_operand(line)
+        if operand is None:
+            return line.strip_comment().split('*')[-1]
+        return operand.text
+
+    def get_target_register(self, line):
+        '''The register holding the target of an indirect branch (call *%rax),
+        None if the target is in memory'''
+        operand = self.get_target_operand(line)
+        if operand is not None and operand.kind == 'register':
+            return operand.reg
 
     # retrun a Line of .org
     def padding_to_slot(self, bit_width, slot):
@@ -220,23 +292,29 @@ class SLOT_INFO():
             if global_env.isa == X86:
                 if global_env.syntax == ATT:
                     call_expr = tk.get_call_expr(branch_line)
-                    lines.append(Line('\tmovq\t%s, %%r11' % call_expr))
+                    # the ID check does not change the register, a target
+                    # already in a register is used as it is (not with
+                    # skip_lib, its jump offset is for %r11)
+                    tmp_reg = None if skip_lib else tk.get_target_register(branch_line)
+                    if tmp_reg is None:
+                        tmp_reg = 'r11'
+                        lines.append(Line('\tmovq\t%s, %%r11' % call_expr))
                     if skip_lib:
-                        lines.append(Line('\tcmpq\t $0xFFFFFFF,  %r11'))
+                        lines.append(Line('\tcmpq\t $0xFFFFFFF,  %%%s' % tmp_reg))
                         lines.append(Line('\tjge\t.+10'))
                     # lines.append(Line('\tsub\t$%s, %%r11' % str(self.width+1)))
-                    lines.append(Line('\tcmpb\t $%s, -%d(%%r11)' %
-                                      (hex(self.value), self.width+1)))
+                    lines.append(Line('\tcmpb\t $%s, -%d(%%%s)' %
+                                      (hex(self.value), self.width+1, tmp_reg)))
                     # lines.append(Line('\tadd\t$%s, %%r11' % str(self.width+1)))
                     lines.append(Line('\tje\t.+3'))
                     if skip_trap:
                         lines.append(Line('\tnop'))
                     else:
                         lines.append(Line('\tint3'))
-                    if 'call' in branch_line:
-                        lines.append(Line('\tcallq \t*%r11\t\t# scfi_call ID'))
+                    if tk.is_call(branch_line):
+                        lines.append(Line('\tcallq \t*%%%s\t\t# scfi_call ID' % tmp_reg))
                     else:
-                        lines.append(Line('\tjmpq \t*%r11\t\t# scfi_call ID'))
+                        lines.append(Line('\tjmpq \t*%%%s\t\t# scfi_call ID' % tmp_reg))
 
                     return lines
             raise Exception('Unsupported syntax or ISA')
@@ -267,7 +345,7 @@ class SLOT_INFO():
                         else:
                             lines.append(Line('\tint3'))
                         # lines.append(Line('\tud2'))
-                        if 'call' in branch_line:
+                        if tk.is_call(branch_line):
                             lines.append(
                                 Line('\tcallq *%s\t\t# scfi_call slot debug' % call_expr))
                         else:
@@ -276,8 +354,9 @@ class SLOT_INFO():
                     else:
                         slot_mask = 0xffffffffffffffff ^ ((1 << slot_width)-1)
                         tmp_reg = '%r11'
-                        if False:  # '(' not in call_expr:
-                            tmp_reg = call_expr
+                        target_reg = tk.get_target_register(branch_line)
+                        if target_reg in X86_SCRATCH_REGS:  # no need to copy
+                            tmp_reg = '%' + target_reg
                         else:
                             lines.append(Line('\tmovq\t%s, %s' %
                                               (call_expr, tmp_reg)))
@@ -289,7 +368,7 @@ class SLOT_INFO():
                                           (hex(slot_mask), tmp_reg)))
                         lines.append(Line('\tor\t$%s, %s' %
                                           (hex(slot_value), tmp_reg)))
-                        if 'call' in branch_line:
+                        if tk.is_call(branch_line):
                             lines.append(
                                 Line('\tcallq \t*%s\t# scfi_call slot' % tmp_reg))
                         else:
@@ -373,15 +452,147 @@ class SLOTS_INFO():
         raise Exception('Multi Real Slot!')
 
 
+def conflict_graph(tag_sets):
+    '''tag -> the set of the tags sharing a target with it (the tags of a
+    multi-tag target need different colors), each tag set is taken once'''
+    neighbors = dict()
+    for tags in set(frozenset(tags) for tags in tag_sets if len(tags) > 1):
+        for tag in tags:
+            try:
+                neighbors[tag].update(tags)
+            except KeyError:
+                neighbors[tag] = set(tags)
+    for tag, tags in neighbors.items():
+        tags.discard(tag)
+    return neighbors
+
+
+def greedy_coloring(neighbors, order):
+    '''Give each tag, in order, the least color not taken by its neighbors'''
+    color = dict()
+    for tag in order:
+        taken = {color[t] for t in neighbors.get(tag, ()) if t in color}
+        c = 0
+        while c in taken:
+            c += 1
+        color[tag] = c
+    return color
+
+
+def dsatur_coloring(neighbors, order):
+    '''DSATUR: color next the tag whose neighbors have the most colors, the
+    first one in order on ties; it gives the least color not taken'''
+    rank = {tag: i for i, tag in enumerate(order)}
+    taken = {tag: set() for tag in order}  # the colors of the neighbors
+    color = dict()
+    # (-saturation, rank): a saturation only grows, the old items are skipped
+    heap = [(0, i) for i in range(len(order))]
+    while heap:
+        saturation, i = heapq.heappop(heap)
+        tag = order[i]
+        if tag in color or -saturation != len(taken[tag]):
+            continue
+        c = 0
+        while c in taken[tag]:
+            c += 1
+        color[tag] = c
+        for t in neighbors.get(tag, ()):
+            if t not in color and c not in taken[t]:
+                taken[t].add(c)
+                heapq.heappush(heap, (-len(taken[t]), rank[t]))
+    return color
+
+
+COLORING_METHODS = {'greedy': greedy_coloring, 'dsatur': dsatur_coloring}
+
+
+def copy_state(value):
+    '''Copy the containers (and the containers in a dict) but not the lines
+    or other objects in them'''
+    if isinstance(value, dict):
+        return {k: copy.copy(v) if isinstance(v, (dict, list, set)) else v
+                for k, v in value.items()}
+    if isinstance(value, (list, set)):
+        return copy.copy(value)
+    if isinstance(value, TagTable):
+        return value.copy()
+    return value
+
+
+class SlotTable():
+    '''The slots of the tags in arrays indexed by the tag number: value, width
+    and is_traditional (array.array), and number, the slot number of the tag.
+    The SLOT_INFO objects are made once for each different slot, slot_list
+    holds them by number (0: the slot of the tags not set).'''
+
+    def __init__(self, size):
+        self.value = array.array('q', bytes(8*size))
+        self.width = array.array('q', bytes(8*size))
+        self.is_traditional = array.array('b', bytes(size))
+        self.number = array.array('q', bytes(8*size))
+        self.slots = dict()  # (value, width, is_traditional) -> slot number
+        self.slot_list = []  # slot number -> SLOT_INFO
+        self.slot_number(0, 0, False)
+
+    def set_slot(self, tag, value, width, is_traditional=False):
+        self.value[tag] = value
+        self.width[tag] = width
+        self.is_traditional[tag] = is_traditional
+        self.number[tag] = self.slot_number(value, width, is_traditional)
+
+    def slot_number(self, value, width, is_traditional):
+        key = (int(value), int(width), bool(is_traditional))
+        try:
+            return self.slots[key]
+        except KeyError:
+            self.slot_list.append(SLOT_INFO(*key))
+            number = self.slots[key] = len(self.slot_list) - 1
+            return number
+
+    def slot_info(self, value, width, is_traditional):
+        return self.slot_list[self.slot_number(value, width, is_traditional)]
+
+    def __getitem__(self, tag):
+        return self.slot_list[self.number[tag]]
+
+    def gather(self, tags):
+        '''The SLOT_INFO of each tag: two lookups mapped over the tags, tag ->
+        slot number -> SLOT_INFO, no per-tag python code'''
+        return list(map(self.slot_list.__getitem__, map(self.number.__getitem__, tags)))
+
+
+class TagTable():
+    '''The statistics of the tags in arrays indexed by the tag number (see
+    CFG.number_tags), shared by the marking, coloring, huffman_after_coloring
+    and log_file. names: tag number -> tag (str)'''
+
+    def __init__(self, names):
+        self.names = names
+        self.branch_count = array.array('q', bytes(8*len(names)))
+        self.target_count = array.array('q', bytes(8*len(names)))
+        self.count = array.array('q', bytes(8*len(names)))  # branches and targets
+        self.targets = [[] for _ in range(len(names))]  # the targets with the tag
+        self.color = array.array('q', bytes(8*len(names)))
+        self.id = array.array('q', bytes(8*len(names)))
+
+    def copy(self):
+        table = copy.copy(self)
+        for name in ('branch_count', 'target_count', 'count', 'color', 'id'):
+            setattr(table, name, array.array('q', getattr(self, name)))
+        table.targets = [list(targets) for targets in self.targets]
+        return table
+
+
 class SCFIAsm(AsmSrc):
     '''SCFI Asm object:
     All valid branches and target are identified by tags (CFG label)
     if one instruction is marked, it has a tag, which is a list of the tags.
-    each tag can be mapped to a slot via self.tag_slot
+    The tags are numbers (CFG.number_tags), self.tag_table has their names
+    and statistics. each tag can be mapped to a slot via self.tag_slot
     '''
 
-    def __init__(self, s, cfg=CFG(), src_path=''):
-        super().__init__(s)
+    def __init__(self, s='', cfg=CFG(), src_path='', lines=None):
+        super().__init__(s, lines=lines)
         self.cfg = cfg
         self.default_fixed_slot_bit_width = 8
         self.max_slot_length = 0  # for huffman-encoding
@@ -391,6 +602,7 @@ class SCFIAsm(AsmSrc):
 
         self.branch_lst = []  # in order
         self.marked_branch_lst = []  # in order
+        self.unmatched_branch_locs = dict()  # reason -> CFG branch locations not marked
         self.marked_target_lst = []
 
         self.valid_branch_tags = set()    # since cfg contains more tags than our object
@@ -398,11 +610,9 @@ class SCFIAsm(AsmSrc):
 
         self.both_valid_tag = set()  # after cutting one side tags, the tags remained
 
-        self.tag_slot = dict()     # tag->SLOT_INFO
+        self.tag_slot = dict()     # tag->SLOT_INFO (a SlotTable after huffman_after_coloring)
 
-        self.tag_branch_count = dict()
-        self.tag_target = dict()  # tag-> target with this tag
-        self.tag_count = dict()
+        self.tag_table = TagTable(self.cfg.number_tags())
 
         self.label_address = dict()
         self.label_size = dict()
@@ -420,6 +630,81 @@ class SCFIAsm(AsmSrc):
 
         self.max_slot_address = 0  # for inserting trampoline
 
+    @property
+    def tag_branch_count(self): return self.tag_table.branch_count
+
+    @property
+    def tag_target(self): return self.tag_table.targets  # tag -> targets with this tag
+
+    @property
+    def tag_count(self): return self.tag_table.count
+
+    @property
+    def tag_color(self): return self.tag_table.color
+
+    @property
+    def tag_id(self): return self.tag_table.id
+
+    def tag_name(self, tag):
+        return self.tag_table.names[tag]
+
+    @contextlib.contextmanager
+    def fork(self):
+        '''Try a variant in place, it is undone at the end of the with block,
+        so many variants can be tried on one parsed file:
+            with asm.fork():
+                asm.scfi_all(max_slot_length=7)
+        The lines are shared, only the edits (journal), the attributes of
+        the asm and the tag/slot attributes of the branches and labels are
+        saved and restored. The lines inserted in a variant keep their key
+        ids (see AsmSrc.own_line), the next variant does not reuse them.
+        fork() is not reentrant: do not nest the with blocks. The variants
+        cannot run concurrently on one SCFIAsm either, they edit the same
+        lines; use a process each (see test_tools/sweep.py).'''
+        checkpoint = self.checkpoint()
+        state = {name: copy_state(value) for name, value in vars(self).items()
+                 if name not in SHARED_STATE}
+        toolkit_state = dict(vars(self.toolkit))
+        line_state = self.save_line_state(self.branch_lst + self.label_list)
+        try:
+            yield self
+        finally:
+            self.rollback(checkpoint)
+            self.restore_line_state(self.branch_lst + self.label_list, line_state)
+            for name in [name for name in vars(self) if name not in SHARED_STATE]:
+                if name not in state:
+                    delattr(self, name)
+            vars(self).update(state)
+            vars(self.toolkit).update(toolkit_state)
+
+    def save_line_state(self, lines):
+        '''The tag/slot attributes of the lines which have any'''
+        line_state = dict()
+        for line in lines:
+            try:
+                line.tags  # the others are set on the tagged lines only
+            except AttributeError:
+                continue
+            line_state[line] = {name: copy_state(getattr(line, name))
+                                for name in LINE_STATE if hasattr(line, name)}
+        return line_state
+
+    def restore_line_state(self, lines, line_state):
+        '''Back to the saved attributes, the lines not saved lose them'''
+        for line in set(lines).union(line_state):
+            saved = line_state.get(line)
+            if saved is None:
+                try:
+                    line.tags
+                except AttributeError:
+                    continue
+                saved = dict()
+            for name in LINE_STATE:
+                if name in saved:
+                    setattr(line, name, saved[name])
+                elif hasattr(line, name):
+                    delattr(line, name)
+
     def mark_all_instructions(self, cfg=None):
         '''Add "tags" for all targets and branches'''
         for line in self.traverse_lines():
@@ -427,7 +712,7 @@ class SCFIAsm(AsmSrc):
                 self.branch_lst.append(line)
         if cfg:
             self.cfg = cfg
-        self.cfg.convert_filename_to_number(self.debug_file_number)
+        self.tag_table = TagTable(self.cfg.number_tags())
         self.mark_all_branches()
         self.mark_all_targets()
         logger.info('marked all instructions')
@@ -437,45 +722,62 @@ class SCFIAsm(AsmSrc):
         logger.info('marked_icalls: %d' % len(self.marked_branch_lst))
         logger.info('marked_targets: %d' % len(self.marked_target_lst))
         logger.info('cfg_branches: %d' % len(self.cfg.branch.keys()))
+        logger.info('unmatched cfg_branches: %d unknown file, %d ambiguous file, %d no branch' % (
+            len(self.unmatched_branch_locs['no file']), len(self.unmatched_branch_locs['ambiguous file']),
+            len(self.unmatched_branch_locs['no branch'])))
         logger.info('cfg_targets: %d' % len(self.cfg.target.keys()))
         logger.info('valid branch tags: %d' % len(self.valid_branch_tags))
         logger.info('valid target tags: %d' % len(self.valid_target_tags))
 
     def mark_all_branches(self):
+        '''Join the branches and the CFG on the (file, line, column) location'''
+        files = self.file_number_trie
+        if files is None:
+            self.update_debug_file_number()
+            files = self.file_number_trie
+        index, unknown = self.cfg.branch_loc_index(files)
+        table = self.tag_table
+        matched = set()
         for branch in self.branch_lst:
-            if branch.debug_loc in self.cfg.branch.keys():
-                setattr(branch, 'tags', self.cfg.branch[branch.debug_loc])
-                self.marked_branch_lst.append(branch)
-                for tag in self.cfg.branch[branch.debug_loc]:
-                    self.valid_branch_tags.add(tag)
-                    try:
-                        self.tag_branch_count[tag] += 1
-                    except KeyError:
-                        self.tag_branch_count[tag] = 1
-                    try:
-                        self.tag_count[tag] += 1
-                    except KeyError:
-                        self.tag_count[tag] = 1
+            try:
+                branch_loc, tags = index[branch.loc]
+            except KeyError:
+                continue
+            matched.add(branch.loc)
+            branch.tags = list(tags)
+            self.marked_branch_lst.append(branch)
+            self.valid_branch_tags.update(tags)
+            for tag in tags:
+                table.branch_count[tag] += 1
+                table.count[tag] += 1
+        ambiguous = [branch_loc for branch_loc in unknown
+                     if branch_loc.split(':')[0] in files.ambiguous]
+        for name in sorted(files.ambiguous):
+            logger.warning('ambiguous file name in the CFG: %s matches %s' % (
+                name, ', '.join(files.candidates(name))))
+        self.unmatched_branch_locs = {
+            'no file': [branch_loc for branch_loc in unknown
+                        if branch_loc.split(':')[0] not in files.ambiguous],  # the file is not in the asm
+            'ambiguous file': ambiguous,  # the file name matches several files
+            'no branch': [branch_loc for loc, (branch_loc, tags) in index.items() if loc not in matched]}
 
     def tag_target_count(self, tag):
-        return len(self.tag_target[tag])
+        return self.tag_table.target_count[tag]
 
     def mark_all_targets(self):
+        table = self.tag_table
         for line in self.label_list:
-            label = line.get_label()
-            if line.get_label() in self.cfg.target.keys():
-                setattr(line, 'tags', self.cfg.target[label])
-                self.marked_target_lst.append(line)
-                for tag in self.cfg.target[label]:
-                    self.valid_target_tags.add(tag)
-                    try:
-                        self.tag_target[tag].add(line)
-                    except KeyError:
-                        self.tag_target[tag] = set([line])
-                    try:
-                        self.tag_count[tag] += 1
-                    except KeyError:
-                        self.tag_count[tag] = 1
+            try:
+                tags = self.cfg.target_tag_ids(line.get_label())
+            except KeyError:
+                continue
+            line.tags = list(tags)
+            self.marked_target_lst.append(line)
+            self.valid_target_tags.update(tags)
+            for tag in tags:
+                table.targets[tag].append(line)
+                table.target_count[tag] += 1
+                table.count[tag] += 1
 
     @property
     def inside_valid_tags(self):
@@ -509,19 +811,19 @@ class SCFIAsm(AsmSrc):
         for target in self.marked_target_lst:
             slots = []
             for tag in target.tags:
-                slot = hash(tag) & ((1 << self.default_fixed_slot_bit_width)-1)
+                slot = hash(self.tag_name(tag)) & ((1 << self.default_fixed_slot_bit_width)-1)
                 self.tag_slot[tag] = (slot, self.default_fixed_slot_bit_width)
                 slots.append(slot)
             setattr(target, 'slots', slots)
         for branch in self.marked_branch_lst:
             slots = []
             for tag in branch.tags:
-                slot = hash(tag) & ((1 << self.default_fixed_slot_bit_width)-1)
+                slot = hash(self.tag_name(tag)) & ((1 << self.default_fixed_slot_bit_width)-1)
                 self.tag_slot[tag] = (slot, self.default_fixed_slot_bit_width)
                 slots.append(slot)
             setattr(target, 'slots', slots)
         for tag in self.tag_slot.keys():
-            logger.debug('random_allocation:\t'+str(tag) +
+            logger.debug('random_allocation:\t'+self.tag_name(tag) +
                          ' -> \t'+hex(self.tag_slot[tag][0]))
 
     def huffman_slot_allocation(self, source='target'):
@@ -546,12 +848,11 @@ class SCFIAsm(AsmSrc):
                 code[key] = code[key][:self.max_variable_slot_bit_width]
             self.tag_slot[key] = (int(code[key], 2), len(code[key]))
             logger.debug("tag %s \t-> %s \t%x(%dbits)" %
-                         (key, code[key], int(code[key], 2), len(code[key])))
+                         (self.tag_name(key), code[key], int(code[key], 2), len(code[key])))
 
     def compile_tmp(self, cmd='', update_label=True):
         logger.info('compiling...')
-        with open(self.tmp_asm_path, 'w') as f:
-            f.writelines((str(i)+'\n' for i in self.traverse_lines()))
+        self.write_to(self.tmp_asm_path)
         if not cmd:
             cmd = 'as %s -o %s' % (self.tmp_asm_path, self.tmp_obj_path)
         logger.debug(cmd)
@@ -567,6 +868,18 @@ class SCFIAsm(AsmSrc):
             self.update_tmp_label_addresses()
         logger.info('Finish compile.')
 
+    def section_sizes(self):
+        '''Section name -> size of the compiled object (objdump -h)'''
+        p = subprocess.run(['objdump', '-h', self.tmp_obj_path],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        sizes = dict()
+        for line in p.stdout.decode('utf-8').split('\n'):
+            fields = line.split()
+            # Idx Name Size VMA LMA File-off Algn
+            if len(fields) >= 7 and fields[0].isdigit():
+                sizes[fields[1]] = int(fields[2], 16)
+        return sizes
+
     # todo, it is not very common
     def remove_single_edge(self):
         return
@@ -578,13 +891,14 @@ class SCFIAsm(AsmSrc):
         '''Try to convert some indirect branches to direct branches'''
         for branch in [b for b in self.marked_branch_lst]:
             '''Some indirect call has a "callq *Label" format, we directly dereference the pointer here.'''
-            if self.toolkit.get_call_expr(branch) in self.label_name_to_line.keys():    # call *Label
+            operand = self.toolkit.get_target_operand(branch)
+            if operand is not None and operand.kind == 'symbol' and operand.disp in self.label_name_to_line:    # call *Label
                 # Label:\n  .quad label_name
-                if self.label_name_to_line[self.toolkit.get_call_expr(branch)].next.get_directive_type() == '.quad':
-                    traget_name = self.label_name_to_line[self.toolkit.get_call_expr(
-                        branch)].next.strip_comment().split()[-1].strip()
+                pointer = self.label_name_to_line[operand.disp]
+                if pointer.next.get_directive_type() == '.quad':
+                    traget_name = pointer.next.strip_comment().split()[-1].strip()
                     if traget_name in self.functions:
-                        branch.set_str("\tcallq\t%s" % traget_name)
+                        self.set_str(branch, "\tcallq\t%s" % traget_name)
                         self.marked_branch_lst.remove(branch)
 
     def new_lds(self):
@@ -647,41 +961,27 @@ class SCFIAsm(AsmSrc):
 
     @property
     def max_color(self):
-        if not self.tag_color.values():
-            return 0
-        return max(self.tag_color.values())  # requires coloring first
-
-    def coloring(self, runtime_first=True):
-        '''Coloring: 0 stands for slot, 1,2,3 for IDs'''
-        self.tag_color = dict()
-        for tag in self.both_valid_tag:
-            self.tag_color[tag] = 0
-        current_max_color = 0
-
+        return max(self.tag_color, default=0)  # requires coloring first
+
+    def coloring(self, runtime_first=True, method='greedy'):
+        '''Coloring: 0 stands for slot, 1,2,3 for IDs
+        The tags of a multi-tag target get different colors: the conflict graph
+        of the tags is built once and colored by method ('greedy' or 'dsatur'),
+        the tags with more branches (runtime_first) or more targets first, so
+        they get the slots.'''
+        start = time.time()
         if runtime_first:
-            def lambda_sort(x): return self.tag_branch_count[tag]
+            def priority(x): return self.tag_branch_count[x]
         else:
-            def lambda_sort(x): return self.tag_target_count(tag)
-        sorted_lst = sorted([tag for tag in self.both_valid_tag],
-                            key=lambda_sort, reverse=True)
-
-        while True:
-            this_round_changed = False
-            for tag in sorted_lst:
-                for target in self.tag_target[tag]:
-                    if len(target.tags) > 1:
-                        sorted_tags = sorted(
-                            [tag for tag in target.tags], key=lambda_sort)
-                        color_set = set()
-                        for t in sorted_tags:
-                            if self.tag_color[t] not in color_set:
-                                color_set.add(self.tag_color[t])
-                            else:
-                                self.tag_color[t] = current_max_color+1
-                                this_round_changed = True
-            current_max_color += 1
-            if not this_round_changed:
-                break
+            def priority(x): return self.tag_target_count(x)
+        order = sorted(self.both_valid_tag, key=lambda x: (-priority(x), x))
+        neighbors = conflict_graph(target.tags for target in self.marked_target_lst)
+        color = COLORING_METHODS[method](neighbors, order)
+        self.tag_color[:] = array.array('q', bytes(8*len(self.tag_color)))
+        for tag, c in color.items():
+            self.tag_color[tag] = c
+        logger.info('Coloring (%s): %d colors, %d conflicting tags, %.2fs' % (
+            method, self.max_color+1, len(neighbors), time.time()-start))
 
         import collections
         logger.debug('Coloring first try (by tag):' +
@@ -697,8 +997,8 @@ class SCFIAsm(AsmSrc):
     def colored_IDs(self):
         '''After coloring, assign each tag a ID'''
         current_ID_of_color = dict()
-        self.tag_id = dict()
-        for tag in self.both_valid_tag:
+        self.tag_id[:] = array.array('q', bytes(8*len(self.tag_id)))
+        for tag in sorted(self.both_valid_tag):
             color = self.tag_color[tag]
             if color:
                 if color in current_ID_of_color:
@@ -709,56 +1009,65 @@ class SCFIAsm(AsmSrc):
                     current_ID_of_color[color] = 1
 
     def huffman_after_coloring(self, orthogonal=True, max_length=6, runtime_first=True):
-        '''After Coloring, use huffman coding encode the color 0 (slots)
-        If the max_length of coding > max_length, make a new color for them.
+        '''After Coloring, encode the color 0 (slots) in codes of <= max_length bits
+        A tag of w targets with a slot code of l bits costs w*2**l (padding), the
+        same cost the huffman coding of 2*(x+y) minimizes. A tag can fall back
+        to a traditional ID (a new color) instead, at the cost of
+        2**(max_length+1)*(w+k), k: the branch count (runtime_first) or the
+        target count (the ID checks). The tags and the code lengths of the least
+        cost are taken at once by package-merge.
         After this, each marked branch has a "slot_info",each marked target has a "slots_info"'''
-        from huffmanx import codebook
+        from huffmanx import package_merge, canonical_codebook
         if len(self.both_valid_tag) <= 1:
             return
 
-        # get all colored in the huffman
-        def get_input():
-            _input = []
-            colored_weight = 0
-            colored_tag = set()
-            for tag in self.both_valid_tag:
-                if self.tag_color[tag] == 0:
-                    _input.append((tag, self.tag_target_count(tag)))
-                else:
-                    colored_weight += self.tag_target_count(tag)
-                    colored_tag.add(tag)
+        slot_tags = [t for t in self.both_valid_tag if self.tag_color[t] == 0]
+        weight = {tag: self.tag_target_count(tag) for tag in slot_tags}
+        colored_weight = sum(self.tag_target_count(t) for t in self.both_valid_tag
+                             if self.tag_color[t])
+        if runtime_first:
+            id_key = {tag: self.tag_branch_count[tag] for tag in slot_tags}
+        else:
+            id_key = weight
+
+        def encode(symbols, fallback):
+            lengths = package_merge([lambda l, w=weight[s]: w*2**l for s in symbols],
+                                    max_length, fallback)
+            return dict(zip(symbols, lengths))
+
+        # the fallback tags share the slot of the colored tags if orthogonal,
+        # keep a code for it if they may be needed
+        with_colored = orthogonal and (colored_weight or len(slot_tags) >= 2**max_length)
+        symbols = list(slot_tags)
+        fallback = [2**(max_length+1)*(weight[t]+id_key[t]) for t in slot_tags]
+        if with_colored:
+            weight['SCFI_COLORED'] = max(colored_weight, 1)
+            symbols.append('SCFI_COLORED')
+            fallback.append(None)
+        lengths = encode(symbols, fallback)
+
+        # fall back to IDs, the lightest ID checks first
+        id_tags = sorted([t for t in slot_tags if lengths[t] is None],
+                         key=lambda x: id_key[x], reverse=True)
+        first_color = self.max_color+1
+        for current_ID, tag in enumerate(reversed(id_tags)):
+            self.tag_color[tag] = first_color+(current_ID//256)
+            self.tag_id[tag] = current_ID % 256
+            colored_weight += weight[tag]
+
+        # the lengths for the final weight of the colored slot
+        if id_tags or with_colored:
+            symbols = [t for t in slot_tags if lengths[t] is not None]
             if orthogonal and colored_weight:
-                _input.append(('SCFI_COLORED', colored_weight))
-            return _input
-
-        code = codebook(get_input(), weight_fun=lambda x, y: 2*(x+y))
-        logger.info("Huffman encoded after coloring (prepare): max length %d" % max(
-            [len(x) for x in code.values()]))
-
-        # if encoding too long
-        if max([len(x) for x in code.values()]) > max_length:
-            current_ID = 0
-            first_color = self.max_color+1
-            if not runtime_first:
-                sorted_lst = sorted([t for t in self.both_valid_tag if self.tag_color[t] == 0],
-                                    key=lambda x: self.tag_target_count(x), reverse=True)
-            else:
-                sorted_lst = sorted([t for t in self.both_valid_tag if self.tag_color[t] == 0],
-                                    key=lambda x: self.tag_branch_count[x], reverse=True)
-            while True:
-                for _ in range(len(sorted_lst)//4):
-                    tag = sorted_lst.pop()
-                    self.tag_color[tag] = first_color+(current_ID//256)
-                    self.tag_id[tag] = current_ID % 256
-                    current_ID += 1
-                code = codebook(get_input(), weight_fun=lambda x, y: 2*(x+y))
-                logger.info("Huffman encoded after coloring (try): max length %d" % max(
-                    [len(x) for x in code.values()]))
-                if max([len(x) for x in code.values()]) <= max_length:
-                    break
+                weight['SCFI_COLORED'] = colored_weight
+                symbols.append('SCFI_COLORED')
+            lengths = encode(symbols, None)
+        code = canonical_codebook(lengths)
+        logger.info("Slot codes after coloring: %d slots, %d IDs, max length %d" % (
+            len(code), len(id_tags), max([len(x) for x in code.values()] or [0])))
 
         # record a global max length
-        self.max_slot_length = max([len(x) for x in code.values()])
+        self.max_slot_length = max([len(x) for x in code.values()] or [0])
 
         # count information
         import collections
@@ -789,39 +1098,47 @@ class SCFIAsm(AsmSrc):
         counts = collections.Counter(lst)
         logger.info('Sorted Coloring (by target):' + str(counts))
 
-        color_slot = None  # slot info for colored
         max_color = self.max_color
-        if orthogonal and 'SCFI_COLORED' in code.keys():
-            color_slot = SLOT_INFO.new_slot(
-                int(code['SCFI_COLORED'], 2), len(code['SCFI_COLORED']))
+        table = SlotTable(len(self.tag_table.names))
         for tag in self.both_valid_tag:
             if self.tag_color[tag]:
-                self.tag_slot[tag] = SLOT_INFO.new_ID(
-                    self.tag_id[tag], self.tag_color[tag])
+                table.set_slot(tag, self.tag_id[tag], self.tag_color[tag], True)
             else:
-                self.tag_slot[tag] = SLOT_INFO.new_slot(
-                    int(code[tag], 2), len(code[tag]))
+                table.set_slot(tag, int(code[tag], 2), len(code[tag]))
+        self.tag_slot = table
+        color_slot = None  # slot info for colored
+        if orthogonal and 'SCFI_COLORED' in code.keys():
+            color_slot = table.slot_info(
+                int(code['SCFI_COLORED'], 2), len(code['SCFI_COLORED']), False)
 
         for branch in self.marked_branch_lst:
             if len(branch.tags) > 1:
                 raise Exception("not supported")
-            setattr(branch, 'slot_info', self.tag_slot[branch.tags[0]])
+        for branch, slot in zip(self.marked_branch_lst,
+                                table.gather([branch.tags[0] for branch in self.marked_branch_lst])):
+            branch.slot_info = slot
 
+        # the targets of the same tags share one SLOTS_INFO
+        patterns = dict()  # frozenset of tags -> SLOTS_INFO
         for target in self.marked_target_lst:
-            setattr(target, 'slots_info', set([]))
-            color_set = set([])
-            for tag in target.tags:
-                target.slots_info.add(self.tag_slot[tag])
-                color_set.add(self.tag_color[tag])
+            key = frozenset(target.tags)
+            try:
+                target.slots_info = patterns[key]
+                continue
+            except KeyError:
+                pass
+            tags = sorted(key)
+            slots = table.gather(tags)
             if orthogonal:
+                color_set = set([self.tag_color[tag] for tag in tags])
                 for i in range(max_color+1):
                     if i in color_set:
                         continue  # has this identifier
                     if i == 0:  # has no slot
-                        target.slots_info.add(color_slot)
+                        slots.append(color_slot)
                     else:
-                        target.slots_info.add(SLOT_INFO.new_ID(0xFF, i))
-            target.slots_info = SLOTS_INFO(target.slots_info)
+                        slots.append(table.slot_info(0xFF, i, True))
+            target.slots_info = patterns[key] = SLOTS_INFO(slots)
 
     def scfi_branch_instrument(self, debug=False, skip_lib=False, skip_low_bit=0):
         for line in self.marked_branch_lst:
@@ -868,7 +1185,7 @@ class SCFIAsm(AsmSrc):
         self.scfi_branch_instrument(
             debug=debug, skip_lib=skip_lib, skip_low_bit=skip_low_bit)
 
-    def scfi_all(self, orthogonal=True, max_slot_length=8, debug=False, skip_lib=False, runtime_first=True, skip_low_bit=0):
+    def scfi_all(self, orthogonal=True, max_slot_length=8, debug=False, skip_lib=False, runtime_first=True, skip_low_bit=0, update_label=True):
         '''Paper version: branch with only one identifier, branch may has multiple.
         Only padding, not trampoline.
         :param orthogonal: Generate orthogonal identifiers
@@ -877,6 +1194,7 @@ class SCFIAsm(AsmSrc):
         :param skip_lib: Generate asm that skip the high memory space.
         :param runtime_first: Runtime first (more branches use slot) or Code Size first (more target use slot).
         :param skip_low_bit: maintain at least n bits aligned for each target
+        :param update_label: update the label addresses after compiling.
         '''
 
         # prepare, after read cfg
@@ -891,7 +1209,7 @@ class SCFIAsm(AsmSrc):
         self.scfi_code_instrument(debug=debug, skip_lib=skip_lib,
                              skip_low_bit=skip_low_bit)
         self.new_lds()
-        self.compile_tmp()
+        self.compile_tmp(update_label=update_label)
 
 
     def random_map(self, bit_width):
@@ -914,38 +1232,47 @@ class SCFIAsm(AsmSrc):
         self.new_lds()
         self.compile_tmp()
 
-    def log_file(self, path):
+    def get_stats(self):
+        '''The statistics of the instrumentation, as written by log_file'''
         import collections
+        stats = collections.OrderedDict()
+        stats['Total icalls number'] = len(self.branch_lst)
+        stats['Marked icalls'] = len(self.marked_branch_lst)
+        stats['Marked targets'] = len(self.marked_target_lst)
+        stats['Valid tags'] = len(self.both_valid_tag)
+        stats['Coloring (by tag)'] = collections.Counter(
+            [self.tag_color[v] for v in self.both_valid_tag])
+
+        max_identifier = 0
+        lst = []
+        for t in self.marked_target_lst:
+            max_identifier = max(max_identifier, len(t.tags))
+            for tag in t.tags:
+                lst.append(self.tag_color[tag])
+        stats['Coloring (by target)'] = collections.Counter(lst)
+        lst = []
+        for t in self.marked_branch_lst:
+            for tag in t.tags:
+                lst.append(self.tag_color[tag])
+        stats['Coloring (by branch)'] = collections.Counter(lst)
+        stats['Max multi-tag target # tag'] = max_identifier
+        stats['Max slot length'] = self.max_slot_length
+
+        lst = []
+        for t in self.marked_target_lst:
+            for s in t.slots_info.slots:
+                if not s.is_traditional:
+                    lst.append(s.width)
+        stats['Slot width (by target)'] = collections.Counter(lst)
+        stats['Padding lines'] = len([line for op, line, old in self.journal
+                                      if op == 'insert' and isinstance(line, PaddingLine)])
+        return stats
+
+    def log_file(self, path):
         with open(path, 'a') as f:
             f.write('Log for %s:\n' % self.tmp_asm_path)
-            f.write('Total icalls number: %d\n' % len(self.branch_lst))
-            f.write('Marked icalls: %d\n' % len(self.marked_branch_lst))
-            f.write('Marked targets: %d\n' % len(self.marked_target_lst))
-            f.write('Valid tags: %d\n' % len(self.both_valid_tag))
-            f.write('Coloring (by tag):' +
-                    str(collections.Counter([self.tag_color[v] for v in self.both_valid_tag]))+'\n')
-
-            max_identifier = 0
-            lst = []
-            for t in self.marked_target_lst:
-                max_identifier = max(max_identifier, len(t.tags))
-                for tag in t.tags:
-                    lst.append(self.tag_color[tag])
-            f.write('Coloring (by target):' +
-                    str(collections.Counter(lst))+'\n')
-            lst = []
-            for t in self.marked_branch_lst:
-                for tag in t.tags:
-                    lst.append(self.tag_color[tag])
-            f.write('Coloring (by branch):' +
-                    str(collections.Counter(lst))+'\n')
-            f.write('Max multi-tag target # tag: %d' % max_identifier+'\n')
-            f.write('Max slot length: %d' % self.max_slot_length+'\n')
-
-            lst = []
-            for t in self.marked_target_lst:
-                for s in t.slots_info.slots:
-                    if not s.is_traditional:
-                        lst.append(s.width)
-            f.write('Slot width (by target):' +
-                    str(collections.Counter(lst))+'\n')
+            for key, value in self.get_stats().items():
+                if isinstance(value, int):
+                    f.write('%s: %d\n' % (key, value))
+                else:
+                    f.write('%s:%s\n' % (key, value))
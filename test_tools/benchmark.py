@@ -0,0 +1,155 @@
+'''Measure the asm tools on a real (or generated) assembly file.
+
+Usage: python benchmark.py asm_file [src_path]
+       python benchmark.py --huffman
+       python benchmark.py --coloring
+'''
+import gc
+import random
+import sys
+import time
+import tracemalloc
+
+from asmplayground import *
+
+
+def asm_memory_per_line(path, src_path='', cls=AsmSrc):
+    '''Peak and retained memory of cls.read_file, per line'''
+    tracemalloc.start()
+    start = time.time()
+    asm = cls.read_file(path, src_path=src_path)
+    used = time.time() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    n = len(asm.lines)
+    print('%s: %d lines, %.2fs' % (path, n, used))
+    print('retained: %.1f MB (%.1f bytes/line)' %
+          (current / 2**20, current / n))
+    print('peak:     %.1f MB (%.1f bytes/line)' % (peak / 2**20, peak / n))
+    return current / n, peak / n
+
+
+def parse_scaling(path, processes=(1, 2, 4, 8), cls=AsmSrc):
+    '''Time cls.read_file with different numbers of processes'''
+    result = {}
+    for p in processes:
+        gc.collect()  # free the lines of the previous run, the pool forks this process
+        start = time.time()
+        cls.read_file(path, processes=p)
+        result[p] = time.time() - start
+        print('processes %d: %.2fs (x%.2f)' % (p, result[p], result[processes[0]] / result[p]))
+    return result
+
+
+def codebook_by_sort(iter, weight_fun=lambda x, y: x+y):
+    '''The codebook built by sorting the nodes before every merge, as
+    huffmanx.codebook did before the heap, for reference'''
+    from huffmanx import Node
+    available = [Node(symbol=i[0], weight=i[1]) for i in iter]
+    copy = [n for n in available]
+    if len(available) == 0:
+        return dict([])
+    while len(available) > 1:
+        available.sort(key=lambda x: x.weight, reverse=True)
+        r = available.pop()
+        l = available.pop()
+        p = Node(left=l, right=r, weight=weight_fun(l.weight, r.weight))
+        l.parent = p
+        r.parent = p
+        available.append(p)
+    return {n.symbol: n.code for n in copy}
+
+
+def huffman_scaling(sizes=(10000, 100000), reference_sizes=(10000,), max_weight=64, seed=0):
+    '''Time huffmanx.codebook on random weights (many ties, as the target
+    counts of tags), with the weight_fun of huffman_after_coloring. The
+    codebooks are checked against codebook_by_sort for reference_sizes.'''
+    from huffmanx import codebook
+    rnd = random.Random(seed)
+    result = {}
+    for n in sizes:
+        items = [('tag%d' % i, rnd.randint(1, max_weight)) for i in range(n)]
+        start = time.time()
+        code = codebook(items, weight_fun=lambda x, y: 2*(x+y))
+        result[n] = time.time() - start
+        line = 'huffman %d symbols: %.3fs, max length %d' % (n, result[n], max(map(len, code.values())))
+        if n in reference_sizes:
+            start = time.time()
+            same = codebook_by_sort(items, weight_fun=lambda x, y: 2*(x+y)) == code
+            line += ', by sort: %.3fs, same: %s' % (time.time() - start, same)
+        print(line)
+    return result
+
+
+def coloring_by_rounds(targets, order):
+    '''The coloring of the tags as SCFIAsm.coloring did before the conflict
+    graph, for reference: in rounds, every tag repeated in a target is moved
+    to a new color, until a round changes nothing'''
+    color = {tag: 0 for tag in order}
+    tag_target = {tag: [] for tag in order}
+    for tags in targets:
+        for tag in tags:
+            tag_target[tag].append(tags)
+    current_max_color = 0
+    while True:
+        changed = False
+        for tag in order:
+            for tags in tag_target[tag]:
+                if len(tags) > 1:
+                    color_set = set()
+                    for t in tags:
+                        if color[t] not in color_set:
+                            color_set.add(color[t])
+                        else:
+                            color[t] = current_max_color+1
+                            changed = True
+        current_max_color += 1
+        if not changed:
+            return color
+
+
+def coloring_scaling(sizes=(3000, 30000), reference_sizes=(3000,), targets_per_tag=4,
+                     max_tags=32, seed=0):
+    '''Color random C++ like workloads: a target (a virtual function) has
+    1..max_tags tags (its class types), few tags are on many targets.
+    Print the number of colors and the time of each method.'''
+    from scfi import conflict_graph, COLORING_METHODS
+    rnd = random.Random(seed)
+    result = {}
+    for n in sizes:
+        tags = ['class.T%d' % i for i in range(n)]
+        targets = []
+        for _ in range(targets_per_tag*n):
+            k = min(max_tags, int(rnd.paretovariate(1.5)))
+            # the tags in front are more common
+            targets.append(rnd.sample(tags[:max(k, int(n / rnd.paretovariate(1)))], k))
+        count = {tag: 0 for tag in tags}
+        for target in targets:
+            for tag in target:
+                count[tag] += 1
+        order = sorted(tags, key=lambda x: (-count[x], x))
+        start = time.time()
+        neighbors = conflict_graph(targets)
+        graph_time = time.time() - start
+        line = 'coloring %d tags, %d targets: graph %.3fs' % (n, len(targets), graph_time)
+        for method, coloring in sorted(COLORING_METHODS.items()):
+            start = time.time()
+            color = coloring(neighbors, order)
+            result[n, method] = time.time() - start + graph_time
+            line += ', %s %d colors %.3fs' % (method, max(color.values())+1, result[n, method])
+        if n in reference_sizes:
+            start = time.time()
+            color = coloring_by_rounds(targets, order)
+            line += ', by rounds %d colors %.3fs' % (max(color.values())+1, time.time() - start)
+        print(line)
+    return result
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == '--huffman':
+        huffman_scaling()
+    elif sys.argv[1] == '--coloring':
+        coloring_scaling()
+    else:
+        asm_memory_per_line(sys.argv[1], *sys.argv[2:3])
+        parse_scaling(sys.argv[1])
@@ -54,22 +54,15 @@ spec_lst = runspec.SPEC2006_C
 # spec_lst=['433.milc']
 
 
-def build_scfi(debug=False, dump_cfg=False):
+def build_scfi(debug=False):
     '''scfi instrument'''
     for name in work_lst:
         filePath = '/home/readm/scfi/workload/%s/work/vtable.s' % name
         src_path = '/home/readm/scfi/workload/%s/work/' % name
         work_path = src_path.replace('fast-cfi', 'scfi')
         cfg_path = '/home/readm/scfi/workload/%s/work/scfi_tmp.cfg' % name
-        if dump_cfg:
-            if os.path.isdir('/home/readm/scfi/workload/%s/doxygen/html/'%name):
-                cfg=CFG.read_from_llvm_pass(cfg_path,inherit_path='/home/readm/scfi/workload/%s/doxygen/html/'%name)#,to_object=True)
-            else:
-                cfg=CFG.read_from_llvm_pass(cfg_path)#,to_object=True)
-            cfg.dump('/home/readm/scfi/workload/%s/work/scfi_tmp.cfgdump' % name)
-            continue
-        cfg=CFG.load(cfg_path+'dump')
-        asm = SCFIAsm.read_file(filePath, src_path=src_path)
+        cfg = CFG.read_from_llvm_pass(cfg_path)  # cached next to it
+        asm = SCFIAsm.read_file(filePath, src_path=src_path, cache_dir=src_path)
         asm.tmp_asm_path = work_path+'scfi_tmp.s'
         asm.tmp_obj_path = work_path+'scfi_tmp.o'
         asm.tmp_dmp_path = work_path+'scfi_tmp.dump'
@@ -80,6 +73,17 @@ def build_scfi(debug=False, dump_cfg=False):
         asm.log_file('/home/readm/scfi/log/scif.log')
 
 
+def sweep_scfi(processes=None):
+    '''scfi_all parameter sweep, the table is in work/sweep/sweep.tsv'''
+    import sweep
+    for name in work_lst:
+        filePath = '/home/readm/scfi/workload/%s/work/vtable.s' % name
+        src_path = '/home/readm/scfi/workload/%s/work/' % name
+        cfg_path = '/home/readm/scfi/workload/%s/work/scfi_tmp.cfg' % name
+        sweep.sweep_file(filePath, CFG.read_from_llvm_pass(cfg_path), src_path+'sweep/',
+                         processes=processes, src_path=src_path)
+
+
 def compile_origin():
     '''compile origin'''
     spec_path = '/home/readm/SPEC2006'
@@ -182,7 +186,6 @@ work_lst = ['483.xalancbmk']
 # lto_compile()
 # prepare_cfg()
 # exit()
-# build_scfi(dump_cfg=True)
 build_scfi(debug=False)
 # run_new(l=['./scfi_tmp'],n=1,link=True)
 # size()
@@ -0,0 +1,114 @@
+'''Sweep the scfi_all parameters on one parsed asm file, in a process pool.
+
+The asm is read and marked once, the workers are forked from the process
+holding it, so they share it (copy on write) and try their configurations
+with SCFIAsm.fork().
+
+Usage: python sweep.py asm_file cfg_file [work_dir] [processes]
+'''
+import csv
+import itertools
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+from scfi import *
+
+logger = logging.getLogger('SCFI')
+
+try:
+    from tqdm import tqdm
+except ImportError:
+    logger.info('No tqdm module found, ignore.')
+    def tqdm(s, **kwargs): return s
+
+
+def all_configs(max_slot_lengths=range(4, 11), skip_low_bits=range(0, 4),
+                orthogonals=(True, False), runtime_firsts=(True, False)):
+    '''The parameter space of scfi_all, as a list of kwargs'''
+    return [dict(max_slot_length=m, skip_low_bit=k, orthogonal=o, runtime_first=r)
+            for m, k, o, r in itertools.product(max_slot_lengths, skip_low_bits,
+                                                orthogonals, runtime_firsts)]
+
+
+_asm = None  # the marked SCFIAsm, inherited by the forked workers
+_work_dir = None
+
+
+def run_config(task):
+    '''Worker: run scfi_all with one configuration, return a table row'''
+    index, config = task
+    row = dict(config)
+    start = time.time()
+    with _asm.fork():
+        prefix = os.path.join(_work_dir, 'scfi_%d' % index)
+        _asm.tmp_asm_path = prefix+'.s'
+        _asm.tmp_obj_path = prefix+'.o'
+        _asm.tmp_dmp_path = prefix+'.dump'
+        _asm.tmp_lds_path = prefix+'.lds'
+        try:
+            _asm.scfi_all(update_label=False, **config)
+            row.update(_asm.get_stats())
+            for name, size in _asm.section_sizes().items():
+                row['size '+name] = size
+        except Exception as e:  # keep the sweep going
+            row['error'] = repr(e)
+    row['time'] = round(time.time()-start, 2)
+    return index, row
+
+
+def sweep(asm, configs, work_dir, processes=None):
+    '''Run the configurations on the marked asm, processes: default is the
+    number of cores. Return the rows in the order of configs.'''
+    global _asm, _work_dir
+    _asm, _work_dir = asm, work_dir
+    os.makedirs(work_dir, exist_ok=True)
+    rows = [None]*len(configs)
+    tasks = list(enumerate(configs))
+    try:
+        if processes == 1:
+            results = map(run_config, tasks)
+            for index, row in tqdm(results, total=len(tasks)):
+                rows[index] = row
+        else:
+            with multiprocessing.get_context('fork').Pool(processes) as pool:
+                results = pool.imap_unordered(run_config, tasks)
+                for index, row in tqdm(results, total=len(tasks)):
+                    rows[index] = row
+    finally:
+        _asm = _work_dir = None
+    return rows
+
+
+def write_table(rows, path):
+    '''Write the rows as a tab separated table, columns in the order seen'''
+    columns = []
+    for row in rows:
+        columns.extend(key for key in row if key not in columns)
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns, delimiter='\t')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def sweep_file(asm_path, cfg, work_dir, processes=None, src_path='', configs=None):
+    '''Read and mark the asm once, sweep, and write work_dir/sweep.tsv
+    cfg: a CFG or the path of the llvm pass output'''
+    os.makedirs(work_dir, exist_ok=True)
+    if not isinstance(cfg, CFG):
+        cfg = CFG.read_from_llvm_pass(cfg)
+    asm = SCFIAsm.read_file(asm_path, src_path=src_path, cache_dir=work_dir)
+    asm.move_file_directives_forward()
+    asm.mark_all_instructions(cfg=cfg)
+    start = time.time()
+    rows = sweep(asm, configs or all_configs(), work_dir, processes)
+    logger.info('sweep: %d configurations in %.1fs' % (len(rows), time.time()-start))
+    write_table(rows, os.path.join(work_dir, 'sweep.tsv'))
+    return rows
+
+
+if __name__ == '__main__':
+    sweep_file(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else '.',
+               int(sys.argv[4]) if len(sys.argv) > 4 else None)